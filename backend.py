@@ -0,0 +1,51 @@
+import os
+import struct
+import pigpio
+
+PIGPIO = "pigpio"
+SIM = "sim"
+REPLAY = "replay"
+
+# GREENHOUSE_BACKEND=sim runs everything against simulated hardware,
+# GREENHOUSE_BACKEND=replay against the recording GREENHOUSE_REPLAY
+BACKEND = os.environ.get("GREENHOUSE_BACKEND", PIGPIO)
+SIM_SPEED = float(os.environ.get("GREENHOUSE_SIM_SPEED", "1.0"))
+REPLAY_PATH = os.environ.get("GREENHOUSE_REPLAY")
+# GREENHOUSE_RECORD=path records the greenhouse's hardware traffic
+RECORD_PATH = os.environ.get("GREENHOUSE_RECORD")
+
+# What a broken connection to pigpiod raises, pigpio's socket reads fail
+# with struct.error on a short read
+CONNECTION_ERRORS = (pigpio.error, OSError, struct.error)
+
+def connect(host=None, port=None, backend=None, show_errors=True, record=None):
+    """
+    Returns a connection to the gpio daemon, or a simulated one.
+    host, port: pigpiod address, pigpio's defaults when None
+    backend (str): PIGPIO, SIM or REPLAY, GREENHOUSE_BACKEND when None
+    show_errors (bool): let pigpio print why it could not connect
+    record (str): record the hardware traffic to this file, see recording
+    """
+    pi = _connect(host, port, backend or BACKEND, show_errors)
+    if record:
+        import recording
+        pi = recording.RecordingPi(pi, record)
+    return pi
+
+def _connect(host, port, backend, show_errors):
+    if backend == SIM:
+        import sim_pigpio
+        return sim_pigpio.SimPi(speed=SIM_SPEED)
+    if backend == REPLAY:
+        import recording
+        if not REPLAY_PATH:
+            raise ValueError("GREENHOUSE_REPLAY names no recording to replay")
+        return recording.ReplayPi(REPLAY_PATH, speed=SIM_SPEED)
+    if backend != PIGPIO:
+        raise ValueError("unknown backend: {}".format(backend))
+    kwargs = {'show_errors': show_errors}
+    if host is not None:
+        kwargs['host'] = host
+    if port is not None:
+        kwargs['port'] = port
+    return pigpio.pi(**kwargs)
@@ -0,0 +1,310 @@
+"""
+Benchmarks of the sensing, decoding and motion hot paths, run against
+the simulated pigpio backend so they need no hardware.
+
+    python bench.py                                 # print a report
+    python bench.py --save baseline.json            # keep the results
+    python bench.py --compare baseline.json         # fail on regressions
+"""
+import argparse
+import array
+import collections
+import json
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import greenhouse
+import mcp3008
+import motion_profile
+import my_dht11
+import sim_pigpio
+import waves
+
+ITERATIONS = 2000
+WARMUP = 50
+# Fail a comparison when a path got this much slower
+THRESHOLD = 0.25
+METRIC = "p50_us"
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name, iterations=ITERATIONS):
+    """
+    Registers a benchmark. The decorated function gets (pi, directory)
+    and returns the function to time, called without arguments, or
+    (function, cleanup) when it leaves something to close.
+    """
+    def register(setup):
+        BENCHMARKS[name] = (setup, iterations)
+        return setup
+    return register
+
+def _captured_frame(pi):
+    edges = sim_pigpio.SimDHT11().edges(0, 0.0, pi.rng)
+    ticks = array.array('L', [0] * my_dht11.MAX_EDGES)
+    levels = bytearray(my_dht11.MAX_EDGES)
+    for i, (level, tick) in enumerate(edges):
+        ticks[i] = tick
+        levels[i] = level
+    return ticks, levels, len(edges)
+
+@benchmark("dht11_decode")
+def bench_dht11_decode(pi, directory):
+    ticks, levels, count = _captured_frame(pi)
+    frame = bytearray(5)
+
+    def call():
+        if my_dht11.decode_edges(ticks, levels, count, frame) == my_dht11.OK:
+            my_dht11.frame_values(frame)
+    return call
+
+@benchmark("dht11_decode_frames_x256", iterations=200)
+def bench_dht11_decode_frames(pi, directory):
+    frames = [_captured_frame(pi) for i in range(256)]
+    ticks = np.array([f[0] for f in frames], dtype=np.int64)
+    levels = np.array([list(f[1]) for f in frames], dtype=np.uint8)
+    counts = np.array([f[2] for f in frames])
+    return lambda: my_dht11.decode_frames(ticks, levels, counts)
+
+@benchmark("mcp3008_read")
+def bench_mcp3008_read(pi, directory):
+    adc = mcp3008.MCP3008(pi)
+    return lambda: adc.read(0)
+
+class _SocketLock(object):
+    # what pigpio.pi keeps as .sl
+    def __init__(self, s):
+        self.s = s
+        self.l = threading.Lock()
+
+class FakePigpiod(object):
+    def __init__(self, pi):
+        """
+        pigpiod's socket side of SPI transfers, answered by the simulated
+        MCP3008s of pi on a thread of its own, so MCP3008.read_channels()
+        takes its pipelined path as on a Pi. Everything else goes
+        straight to pi.
+        pi (sim_pigpio.SimPi): the simulated hardware
+        """
+        self.pi = pi
+        ours, self._theirs = socket.socketpair()
+        self.sl = _SocketLock(ours)
+        self._server = threading.Thread(target=self._serve)
+        self._server.daemon = True
+        self._server.start()
+
+    def __getattr__(self, name):
+        return getattr(self.pi, name)
+
+    def _serve(self):
+        pending = bytearray()
+        while True:
+            data = self._theirs.recv(65536)
+            if not data:
+                self._theirs.close()
+                return
+            pending.extend(data)
+            replies = bytearray()
+            # command, handle, 0, size, then size bytes to transfer
+            while len(pending) >= 16:
+                cmd, handle, p2, size = struct.unpack_from('IIII', pending)
+                if len(pending) < 16 + size:
+                    break
+                count, received = self.pi.spi_xfer(handle, pending[16:16 + size])
+                del pending[:16 + size]
+                replies.extend(struct.pack('IIIi', cmd, handle, p2, count))
+                replies.extend(received[:count])
+            self._theirs.sendall(replies)
+
+    def stop(self):
+        self.sl.s.close()
+        self._server.join()
+
+@benchmark("mcp3008_read_channels")
+def bench_mcp3008_read_channels(pi, directory):
+    # pipelined through a socket, as to pigpiod
+    pigpiod = FakePigpiod(pi)
+    adc = mcp3008.MCP3008(pigpiod)
+    return lambda: adc.read_channels(oversample=4, method=mcp3008.MEDIAN), pigpiod.stop
+
+@benchmark("mcp3008_read_channels_fallback")
+def bench_mcp3008_read_channels_fallback(pi, directory):
+    # one spi_xfer() per transfer, as on backends without a socket
+    adc = mcp3008.MCP3008(pi)
+    return lambda: adc.read_channels(oversample=4, method=mcp3008.MEDIAN)
+
+@benchmark("periodic_tick")
+def bench_periodic_tick(pi, directory):
+    # Greenhouse.sample() itself, on hardware of its own as the greenhouse
+    # adds the simulated door to it, with the moisture read over the
+    # socket as on a Pi. The DHT11 workers are not started.
+    pigpiod = FakePigpiod(sim_pigpio.SimPi(seed=0))
+    house = greenhouse.Greenhouse(pigpiod, log_dir=directory)
+
+    def cleanup():
+        house.stop()
+        pigpiod.stop()
+        pigpiod.pi.stop()
+    return house.sample, cleanup
+
+@benchmark("door_waves", iterations=100)
+def bench_door_waves(pi, directory):
+    # the full door move's waves from scratch, as on the first open, with
+    # the door set up as in the greenhouse and its profile from the cache
+    cache = waves.WaveCache(pi, greenhouse.PIN_STEP)
+
+    def call():
+        profile = motion_profile.profile(int(greenhouse.TOTAL_STEPS), greenhouse.STEPS_PER_M,
+                                         greenhouse.ACCELERATION_MS2, greenhouse.MAX_VELOCITY_MS,
+                                         greenhouse.MOTION_PROFILE, greenhouse.JERK_MS3)
+        segments, ramp = waves.plan(profile)
+        cache.clear()
+        pi.wave_chain(cache.chain(segments))
+        pi.wave_tx_stop()
+    return call
+
+def measure(call, iterations, warmup=WARMUP):
+    """
+    Times call, then runs it again under tracemalloc for its memory use.
+    Returns a dict of the results.
+    """
+    for i in range(warmup):
+        call()
+
+    durations = np.empty(iterations)
+    clock = time.perf_counter
+    started = clock()
+    for i in range(iterations):
+        t = clock()
+        call()
+        durations[i] = clock() - t
+    elapsed = clock() - started
+
+    # Peak is the most held at once during a call, above what was held
+    # before it, retained what is still held after all calls
+    samples = max(1, iterations // 10)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    peak = 0
+    for i in range(samples):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    durations *= 1000000
+    return {
+        "iterations": iterations,
+        "mean_us": float(durations.mean()),
+        "p50_us": float(np.percentile(durations, 50)),
+        "p90_us": float(np.percentile(durations, 90)),
+        "p99_us": float(np.percentile(durations, 99)),
+        "max_us": float(durations.max()),
+        "calls_per_s": iterations / elapsed,
+        "peak_bytes": int(peak),
+        "retained_bytes_per_call": retained / float(samples),
+    }
+
+def run(names=None, iterations=None, seed=0):
+    """
+    Runs the benchmarks named, or all of them.
+    Returns {name: results} in registration order.
+    """
+    results = collections.OrderedDict()
+    directory = tempfile.mkdtemp(prefix="greenhouse-bench-")
+    pi = sim_pigpio.SimPi(seed=seed)
+    try:
+        for name, (setup, default_iterations) in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            call = setup(pi, directory)
+            cleanup = None
+            if isinstance(call, tuple):
+                call, cleanup = call
+            try:
+                results[name] = measure(call, iterations or default_iterations)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+    finally:
+        pi.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def compare(results, baseline, threshold=THRESHOLD, metric=METRIC):
+    """
+    Returns [(name, baseline, current, change)] of the benchmarks in both,
+    and the names of those that got slower than threshold.
+    """
+    rows = []
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name][metric]
+        change = current[metric] / before - 1.0 if before else 0.0
+        rows.append((name, before, current[metric], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+def report(results, out=sys.stdout):
+    out.write("{:<32} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}\n".format(
+        "benchmark", "p50 µs", "p90 µs", "p99 µs", "max µs", "calls/s", "peak B"))
+    for name, r in results.items():
+        out.write("{:<32} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.0f} {:>10}\n".format(
+            name, r["p50_us"], r["p90_us"], r["p99_us"], r["max_us"], r["calls_per_s"],
+            r["peak_bytes"]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--iterations", type=int, help="calls per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown, 0.25 is 25%% (default)")
+    parser.add_argument("--metric", default=METRIC,
+                        choices=["mean_us", "p50_us", "p90_us", "p99_us"])
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    results = run(args.names, args.iterations)
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        rows, regressions = compare(results, baseline, args.threshold, args.metric)
+        print("\n{:<32} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "change"))
+        for name, before, current, change in rows:
+            print("{:<32} {:>12.1f} {:>12.1f} {:>+7.0%}{}".format(
+                name, before, current, change, "  REGRESSION" if name in regressions else ""))
+        if regressions:
+            print("\n{} regressed past {:.0%} ({})".format(", ".join(regressions), args.threshold,
+                                                          args.metric))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
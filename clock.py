@@ -0,0 +1,58 @@
+"""
+The clock the greenhouse runs by. On a Pi it is the wall clock. Simulated
+hardware brings its own, which may run faster than real time, and the
+sampling tick, the control period, DHT11 reads and door moves follow it.
+"""
+import time
+
+class Clock(object):
+    """
+    The wall clock.
+    """
+    speed = 1.0
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        """
+        Waits for event at most seconds, returns True if it is set.
+        """
+        return event.wait(max(seconds, 0))
+
+class ScaledClock(Clock):
+    def __init__(self, speed=1.0):
+        """
+        A clock starting at the current time and running speed times
+        faster than the wall clock.
+        """
+        self.speed = speed
+        self.started = time.time()
+
+    def elapsed(self):
+        """
+        Seconds of this clock since it started.
+        """
+        return (time.time() - self.started) * self.speed
+
+    def time(self):
+        return self.started + self.elapsed()
+
+    def sleep(self, seconds):
+        Clock.sleep(self, seconds / self.speed)
+
+    def wait(self, event, seconds):
+        return Clock.wait(self, event, seconds / self.speed)
+
+WALL = Clock()
+
+def of(pi):
+    """
+    Returns the clock of a pigpio connection, the wall clock unless it
+    brings its own.
+    """
+    return getattr(pi, "clock", None) or WALL
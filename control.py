@@ -0,0 +1,286 @@
+import datetime
+import threading
+import pigpio
+import backend
+import events
+from clock import WALL
+
+OFF = 0
+ON = 1
+AUTO = 2
+
+class Actuator(object):
+    def __init__(self, pi, gpio, min_on_s=0.0, min_off_s=0.0, bank=None):
+        """
+        A switched output, written only when its state actually changes.
+        pi (pigpio): an instance of pigpio
+        gpio (int): gpio pin number
+        min_on_s (float): shortest time it stays on once switched on
+        min_off_s (float): shortest time it stays off once switched off
+        bank (outputs.OutputBank): stage the writes in it rather than
+            writing straight away, the ControlEngine flushes it; state
+            follows once the bank has written them
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.bank = bank
+        self.min_on_s = min_on_s
+        self.min_off_s = min_off_s
+        self.mode = AUTO
+        self.state = None
+        self.changed_at = 0.0
+        # (on, now) staged in the bank and not written yet
+        self.pending = None
+        self.pi.set_mode(self.gpio, pigpio.OUTPUT)
+
+    def switch(self, on, now, force=False):
+        """
+        Switches the output on or off, unless it is already there or it
+        has not been in its current state for its minimum time.
+        Returns True if the output was written.
+        """
+        on = bool(on)
+        if on == self.state:
+            if self.pending is not None:
+                # switched back before the bank wrote the change
+                self.bank.set(self.gpio, int(on))
+                self.pending = None
+            return False
+        if not force and self.state is not None:
+            held = now - self.changed_at
+            if held < (self.min_on_s if self.state else self.min_off_s):
+                return False
+        if self.bank is not None:
+            self.bank.set(self.gpio, int(on))
+            self.pending = (on, now)
+            return True
+        self.pi.write(self.gpio, int(on))
+        self.state = on
+        self.changed_at = now
+        return True
+
+    def sync(self):
+        """
+        Takes on the state staged in the bank once the bank has written
+        it, a failed flush leaves it pending and switch() stages it again.
+        """
+        if self.pending is None:
+            return
+        on, now = self.pending
+        if self.bank.level(self.gpio) == int(on):
+            self.state = on
+            self.changed_at = now
+            self.pending = None
+
+def _value(source, readings):
+    if callable(source):
+        return source(readings)
+    return readings.get(source)
+
+class Hysteresis(object):
+    def __init__(self, source, on_above=None, off_below=None, on_below=None, off_above=None):
+        """
+        Switches on when the reading crosses one threshold and off when it
+        crosses back past the other, e.g. a fan with on_above=28,
+        off_below=26, or a pump with on_above=dry, off_below=wet.
+        source (str or callable): reading name, or a function of the readings
+        """
+        self.source = source
+        self.on_above = on_above
+        self.off_below = off_below
+        self.on_below = on_below
+        self.off_above = off_above
+
+    def evaluate(self, readings, now, state):
+        value = _value(self.source, readings)
+        if value is None:
+            return None
+        if self.on_above is not None and value > self.on_above:
+            return True
+        if self.on_below is not None and value < self.on_below:
+            return True
+        if self.off_below is not None and value < self.off_below:
+            return False
+        if self.off_above is not None and value > self.off_above:
+            return False
+        return bool(state)
+
+class PID(object):
+    def __init__(self, source, setpoint, kp, ki=0.0, kd=0.0, window_s=60.0, reverse=False):
+        """
+        PID controller driving an on/off output by time proportioning: the
+        output is on for the controller's 0..1 output share of each window.
+        reverse (bool): True when switching on lowers the reading, e.g. a
+            fan against temperature
+        """
+        self.source = source
+        self.setpoint = setpoint
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.window_s = window_s
+        self.reverse = reverse
+        self.integral = 0.0
+        self.last_error = None
+        self.last_time = None
+        self.output = 0.0
+
+    def evaluate(self, readings, now, state):
+        value = _value(self.source, readings)
+        if value is None:
+            return None
+        error = self.setpoint - value
+        if self.reverse:
+            error = -error
+        dt = now - self.last_time if self.last_time is not None else 0.0
+        derivative = 0.0
+        if dt > 0:
+            self.integral += error * dt
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        self.last_time = now
+
+        output = self.kp * error + self.ki * self.integral + self.kd * derivative
+        if output > 1.0 or output < 0.0:
+            # anti windup, undo the integration that pushed us out of range
+            self.integral -= error * dt
+            output = min(max(output, 0.0), 1.0)
+        self.output = output
+        return (now % self.window_s) < output * self.window_s
+
+class Schedule(object):
+    def __init__(self, on_time, off_time):
+        """
+        On between two times of day, given as datetime.time. The period
+        may wrap around midnight.
+        """
+        self.on_time = on_time
+        self.off_time = off_time
+
+    def evaluate(self, readings, now, state):
+        t = datetime.datetime.fromtimestamp(now).time()
+        if self.on_time <= self.off_time:
+            return self.on_time <= t < self.off_time
+        return t >= self.on_time or t < self.off_time
+
+class ControlEngine(object):
+    def __init__(self, read_inputs, period_s=1.0, clock=None):
+        """
+        Runs the control rules on its own thread at a fixed period,
+        independent of the UI.
+        read_inputs (callable): returns a dict of the current readings
+        period_s (float): control period
+        clock (clock.Clock): runs the period, the wall clock when None
+        """
+        self.read_inputs = read_inputs
+        self.period_s = period_s
+        self.clock = clock or WALL
+        self.actuators = {}
+        self.rules = {}
+        self.readings = {}
+
+        # How late each cycle started against its schedule
+        self.cycles = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._worker = None
+
+    def add(self, name, actuator, rule):
+        """
+        Adds an actuator driven by rule in AUTO mode. A rule has
+        evaluate(readings, now, state) returning True, False, or None to
+        leave the output alone.
+        """
+        self.actuators[name] = actuator
+        self.rules[name] = rule
+
+    def set_mode(self, name, mode):
+        """
+        Sets an actuator to OFF, ON or AUTO. Manual modes apply straight
+        away, AUTO on the next cycle.
+        """
+        with self._lock:
+            actuator = self.actuators[name]
+            actuator.mode = mode
+            if mode != AUTO:
+                actuator.switch(mode == ON, self.clock.time(), force=True)
+                self._flush()
+
+    @property
+    def mean_jitter(self):
+        return self.total_jitter / self.cycles if self.cycles else 0.0
+
+    def step(self, now):
+        """
+        Runs one control cycle.
+        """
+        readings = self.read_inputs()
+        with self._lock:
+            self.readings = readings
+            for name, actuator in self.actuators.items():
+                if actuator.mode != AUTO:
+                    continue
+                on = self.rules[name].evaluate(readings, now, actuator.state)
+                if on is not None:
+                    actuator.switch(on, now)
+            # every output changed this cycle switches at once
+            self._flush()
+
+    def _flush(self):
+        banks = []
+        for actuator in self.actuators.values():
+            if actuator.bank is not None and actuator.bank not in banks:
+                banks.append(actuator.bank)
+        try:
+            for bank in banks:
+                bank.flush()
+        finally:
+            # outputs written before a failure count as switched
+            for actuator in self.actuators.values():
+                if actuator.bank is not None:
+                    actuator.sync()
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        if self._worker is None:
+            return
+        self._stop_event.set()
+        self._worker.join()
+        self._worker = None
+
+    def _run(self):
+        clock = self.clock
+        next_cycle = clock.time()
+        while True:
+            delay = next_cycle - clock.time()
+            if delay > 0 and clock.wait(self._stop_event, delay):
+                return
+            if self._stop_event.is_set():
+                return
+            now = clock.time()
+            jitter = now - next_cycle
+            self.cycles += 1
+            self.last_jitter = jitter
+            self.max_jitter = max(self.max_jitter, jitter)
+            self.total_jitter += jitter
+
+            try:
+                self.step(now)
+            except backend.CONNECTION_ERRORS as e:
+                events.error("control.cycle_failed", error=e)
+
+            next_cycle += self.period_s
+            if next_cycle < clock.time():
+                # Overran whole periods, skip them rather than catch up
+                next_cycle = clock.time() + self.period_s
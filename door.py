@@ -0,0 +1,345 @@
+import threading
+import numpy as np
+import pigpio
+import backend
+import clock
+import events
+import metrics
+import motion_profile
+import waves
+
+DOOR_CLOSED = 0
+DOOR_OPEN = 1
+DOOR_UNKNOWN = 2
+
+# Level of the DIR pin when moving towards each end
+DIR_OPENING = 0
+DIR_CLOSING = 1
+
+# How often the monitor thread reports progress
+PROGRESS_INTERVAL_S = 0.05
+# With a lightgate at the closed end, closing moves go this share of the
+# full travel past where the door is thought to close, and are stopped
+# by the lightgate
+HOMING_MARGIN = 0.1
+
+MOVE_SECONDS = metrics.histogram("greenhouse_door_move_seconds", "Duration of door moves",
+                                 ("result",), buckets=metrics.DURATION_BUCKETS)
+MOVES_COMPLETED = MOVE_SECONDS.labels("completed")
+MOVES_STOPPED = MOVE_SECONDS.labels("stopped")
+MOVES_HOMED = MOVE_SECONDS.labels("homed")
+
+class DoorMove(object):
+    """
+    The wave plan and timing of one move, created by DoorController.
+    """
+    def __init__(self, num_steps, profile):
+        """
+        profile (motion_profile.Profile): step timing of the move
+        """
+        self.num_steps = num_steps
+        self.segments, accel = waves.plan(profile)
+
+        # Times in seconds at which each ramp step has been completed, used
+        # to estimate the position from the time since the chain started
+        self.accel_times = np.cumsum(accel) / 1000000.0
+        self.decel_times = np.cumsum(accel[::-1]) / 1000000.0
+        self.accel_duration = self.accel_times[-1] if len(self.accel_times) else 0.0
+        self.const_delay = profile.const_delay / 1000000.0
+        self.const_steps = max(profile.const_steps, 0)
+        self.const_duration = self.const_steps * self.const_delay
+        self.duration = 2 * self.accel_duration + self.const_duration
+
+    def steps_done(self, elapsed):
+        """
+        Number of steps completed elapsed seconds after the move started.
+        """
+        if elapsed < self.accel_duration:
+            return int(np.searchsorted(self.accel_times, elapsed, side='right'))
+        elapsed -= self.accel_duration
+        ramp_steps = len(self.accel_times)
+        if elapsed < self.const_duration:
+            return ramp_steps + int(elapsed / self.const_delay)
+        elapsed -= self.const_duration
+        decel_steps = int(np.searchsorted(self.decel_times, elapsed, side='right'))
+        return ramp_steps + self.const_steps + decel_steps
+
+class DoorController(object):
+    def __init__(self, pi, pin_step, pin_dir, pin_enn, total_steps, steps_per_m,
+                 acceleration_ms2, max_velocity_ms, on_progress=None, on_finished=None,
+                 profile_kind=motion_profile.TRAPEZOIDAL, jerk_ms3=None, lightgate=None,
+                 bank=None):
+        """
+        Moves the door without blocking the caller.
+        profile_kind (str): motion_profile.TRAPEZOIDAL or motion_profile.S_CURVE
+        jerk_ms3 (float): jerk limit of S_CURVE profiles
+        lightgate (lightgate.Lightgate): blocked while the door is closed.
+            Without one the door is assumed closed at first and its
+            position is only estimated from the steps sent. With one the
+            door is closed only once the lightgate says so: closing moves
+            run past the estimate and the lightgate's edge stops the
+            waves, so every close homes the door. A lightgate already
+            blocked when the door is thought to be away does not stop
+            the close, it then goes by the steps.
+        bank (outputs.OutputBank): write DIR and ENN through it, together
+        A monitor thread follows each move and reports it through the
+        callbacks, which are called from that thread:
+        on_progress(controller, progress): progress (float) of the move 0..1
+        on_finished(controller): the move ended, stopped or was reversed
+        """
+        self.pi = pi
+        self.pin_step = pin_step
+        self.pin_dir = pin_dir
+        self.pin_enn = pin_enn
+        self.total_steps = int(total_steps)
+        self.steps_per_m = steps_per_m
+        self.acceleration_ms2 = acceleration_ms2
+        self.max_velocity_ms = max_velocity_ms
+        self.profile_kind = profile_kind
+        self.jerk_ms3 = jerk_ms3
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.lightgate = lightgate
+        self.bank = bank
+        # times the moves, the waves take the time of pi's clock
+        self.clock = clock.of(pi)
+
+        # Position in steps from the closed end, estimated during moves
+        self.steps = 0
+        self.door_position = DOOR_CLOSED
+        self.direction = None
+
+        self._lock = threading.RLock()
+        self._move = None
+        self._monitor = None
+        self._stop_event = threading.Event()
+        self._started_at = 0.0
+        self._stopped_at = None
+        self._homed = False
+
+        self.pi.set_mode(self.pin_step, pigpio.OUTPUT)
+        self.pi.set_mode(self.pin_enn, pigpio.OUTPUT)
+        self.pi.set_mode(self.pin_dir, pigpio.OUTPUT)
+
+        self.waves = waves.WaveCache(self.pi, self.pin_step)
+        # A full travel is the common case, keep its plans around once they
+        # are first needed, planning them up front slows down startup
+        self._full_moves = {}
+
+        if self.lightgate is not None:
+            if not self.lightgate.blocked:
+                # anywhere, the first close goes the full travel
+                self.steps = self.total_steps
+                self.door_position = DOOR_UNKNOWN
+            self.lightgate.subscribe(self._on_lightgate)
+
+    @property
+    def moving(self):
+        return self._move is not None
+
+    @property
+    def position(self):
+        """
+        Estimated door position, 0 is closed and 1 is open.
+        """
+        with self._lock:
+            steps = self.steps
+            if self._move is not None:
+                steps = self._current_steps(self.clock.time())
+        return min(max(steps / float(self.total_steps), 0.0), 1.0)
+
+    def open(self):
+        self.move_to(DOOR_OPEN)
+
+    def close(self):
+        self.move_to(DOOR_CLOSED)
+
+    def toggle(self):
+        """
+        Reverses a running move, otherwise opens a closed door and closes
+        an open or half open one.
+        """
+        if self._move is not None:
+            self.reverse()
+        elif self.door_position == DOOR_CLOSED:
+            self.open()
+        else:
+            self.close()
+
+    def home(self):
+        """
+        Closes the door until the lightgate sees it, from wherever it is,
+        whatever its position is thought to be.
+        """
+        if self.lightgate is None:
+            raise RuntimeError("homing needs a lightgate")
+        self.cancel()
+        with self._lock:
+            if not self.lightgate.blocked:
+                self.steps = self.total_steps
+        self.move_to(DOOR_CLOSED)
+
+    def reverse(self):
+        """
+        Stops a running move and drives the door back where it came from.
+        """
+        if self._move is None:
+            return
+        self.move_to(DOOR_CLOSED if self.direction == DIR_OPENING else DOOR_OPEN)
+
+    def move_to(self, target):
+        """
+        Starts moving the door to DOOR_OPEN or DOOR_CLOSED and returns
+        straight away. A running move is stopped first.
+        """
+        self.cancel()
+        with self._lock:
+            homing = target == DOOR_CLOSED and self.lightgate is not None
+            if homing and self.lightgate.blocked and self.steps <= 0:
+                self.door_position = DOOR_CLOSED
+                return
+            target_steps = self.total_steps if target == DOOR_OPEN else 0
+            num_steps = abs(target_steps - self.steps)
+            if homing:
+                num_steps += int(HOMING_MARGIN * self.total_steps)
+            if num_steps == 0:
+                self.door_position = target
+                return
+
+            full = self.total_steps + (int(HOMING_MARGIN * self.total_steps) if homing else 0)
+            if num_steps == full:
+                move = self._full_moves.get(num_steps)
+                if move is None:
+                    move = self._full_moves[num_steps] = self._create_move(num_steps)
+            else:
+                move = self._create_move(num_steps)
+
+            self.direction = DIR_OPENING if target == DOOR_OPEN else DIR_CLOSING
+            self._write((self.pin_dir, self.direction), (self.pin_enn, 0))
+            self.door_position = DOOR_UNKNOWN
+
+            self._move = move
+            self._stop_event.clear()
+            self._stopped_at = None
+            self._homed = False
+            self._started_at = self.clock.time()
+            self.pi.wave_chain(self.waves.chain(move.segments))
+
+            self._monitor = threading.Thread(target=self._follow_move, args=(move,))
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def cancel(self):
+        """
+        Stops a running move. The door is left where it is, in DOOR_UNKNOWN
+        state unless it happened to be at either end.
+        """
+        with self._lock:
+            if self._move is None:
+                return
+            self.pi.wave_tx_stop()
+            self._stopped_at = self.clock.time()
+            self._stop_event.set()
+            monitor = self._monitor
+        if monitor is not threading.current_thread():
+            monitor.join()
+
+    def set_speed(self, max_velocity_ms, acceleration_ms2=None):
+        """
+        Changes the speed of the next moves. Profiles are cached and the
+        waves are created on the next move.
+        """
+        with self._lock:
+            if self._move is not None:
+                raise RuntimeError("cannot change speed while the door is moving")
+            self.max_velocity_ms = max_velocity_ms
+            if acceleration_ms2 is not None:
+                self.acceleration_ms2 = acceleration_ms2
+            self._full_moves = {}
+
+    def _on_lightgate(self, blocked, tick):
+        # from pigpio's callback thread, the door reached the closed end:
+        # stop the waves there and then, the monitor does the rest
+        if not blocked:
+            return
+        with self._lock:
+            if self._move is None or self.direction != DIR_CLOSING or self._stopped_at is not None:
+                return
+            self.pi.wave_tx_stop()
+            self._stopped_at = self.lightgate.tick_time(tick)
+            self._homed = True
+            self._stop_event.set()
+
+    def _write(self, *levels):
+        # (gpio, level) pairs, in one go when there is a bank
+        if self.bank is None:
+            for gpio, level in levels:
+                self.pi.write(gpio, level)
+            return
+        for gpio, level in levels:
+            self.bank.set(gpio, level)
+        self.bank.flush()
+
+    def _create_move(self, num_steps):
+        profile = motion_profile.profile(num_steps, self.steps_per_m, self.acceleration_ms2,
+                                         self.max_velocity_ms, self.profile_kind, self.jerk_ms3)
+        return DoorMove(num_steps, profile)
+
+    def _current_steps(self, now):
+        done = self._move.steps_done(now - self._started_at)
+        if self.direction == DIR_OPENING:
+            return self.steps + done
+        return self.steps - done
+
+    def _follow_move(self, move):
+        while not self._stop_event.wait(PROGRESS_INTERVAL_S):
+            try:
+                busy = self.pi.wave_tx_busy()
+            except backend.CONNECTION_ERRORS as e:
+                # cannot tell where the waves got to, finish the move as
+                # stopped here rather than leave the door moving
+                events.error("door.monitor_failed", error=e)
+                with self._lock:
+                    if self._stopped_at is None:
+                        self._stopped_at = self.clock.time()
+                break
+            if not busy:
+                break
+            if self.on_progress:
+                progress = (self.clock.time() - self._started_at) / move.duration
+                self.on_progress(self, min(progress, 1.0))
+
+        with self._lock:
+            if self._homed:
+                self.steps = 0
+                MOVES_HOMED.observe(self._stopped_at - self._started_at)
+            elif self._stopped_at is None:
+                self.steps += move.num_steps if self.direction == DIR_OPENING else -move.num_steps
+                MOVES_COMPLETED.observe(self.clock.time() - self._started_at)
+            else:
+                self.steps = self._current_steps(self._stopped_at)
+                MOVES_STOPPED.observe(self._stopped_at - self._started_at)
+            self._move = None
+
+            if self.steps <= 0 and self.lightgate is not None and not self.lightgate.blocked:
+                if self._stopped_at is None:
+                    # went all the way without the lightgate seeing the door
+                    events.error("door.lightgate_missed", steps=move.num_steps)
+                self.steps = 0
+                self.door_position = DOOR_UNKNOWN
+            elif self.steps <= 0:
+                self.steps = 0
+                self.door_position = DOOR_CLOSED
+                # Nothing to hold up, let the motor cool down
+                try:
+                    self._write((self.pin_enn, 1))
+                except backend.CONNECTION_ERRORS as e:
+                    events.error("door.disable_failed", error=e)
+            elif self.steps >= self.total_steps:
+                self.steps = self.total_steps
+                self.door_position = DOOR_OPEN
+            else:
+                self.door_position = DOOR_UNKNOWN
+
+        if self.on_finished:
+            self.on_finished(self)
@@ -0,0 +1,194 @@
+"""
+Leveled, structured event log. Events are queued by the thread logging
+them and formatted and written by a background thread, so logging never
+blocks a sensor tick or a door move on a slow terminal or pipe.
+
+    events.error("dht11.bad_checksum", gpio=12)
+
+is written as
+
+    2026-10-18 12:00:00.123 ERROR dht11.bad_checksum gpio=12
+
+or as a JSON object per line with GREENHOUSE_LOG_FORMAT=json. Field
+values are formatted later on the writer thread, do not change them after
+logging them.
+"""
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+TEXT = "text"
+JSON = "json"
+
+LEVEL = dict((name, level) for level, name in LEVEL_NAMES.items()).get(
+    os.environ.get("GREENHOUSE_LOG_LEVEL", "INFO").upper(), INFO)
+FORMAT = os.environ.get("GREENHOUSE_LOG_FORMAT", TEXT)
+
+# Events queued beyond this are dropped, and counted
+QUEUE_SIZE = 1024
+# Each event name, or name and rate key, may log a burst of RATE_BURST,
+# then RATE_PER_S on average. Past that only every SAMPLE_EVERY-th event is written, with
+# the number left out since the last one written.
+RATE_PER_S = 1.0
+RATE_BURST = 10
+SAMPLE_EVERY = 100
+
+def _format_value(value):
+    text = value if isinstance(value, str) else str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+def _plain(value):
+    # NumPy arrays and numbers as the lists and numbers JSON knows
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    tolist = getattr(value, "tolist", None)
+    if tolist is not None:
+        return tolist()
+    return str(value)
+
+class _Bucket(object):
+    __slots__ = ("tokens", "updated", "suppressed")
+
+    def __init__(self, now, burst):
+        self.tokens = burst
+        self.updated = now
+        self.suppressed = 0
+
+class EventLog(object):
+    def __init__(self, out=None, level=LEVEL, format=FORMAT, queue_size=QUEUE_SIZE,
+                 rate_per_s=RATE_PER_S, burst=RATE_BURST, sample_every=SAMPLE_EVERY):
+        """
+        out (file): where to write, stderr by default
+        level (int): events below it are ignored
+        format (str): TEXT or JSON
+        rate_per_s, burst, sample_every: rate limit of each event name
+            and rate key, rate_per_s 0 for none
+        """
+        self.out = out
+        self.level = level
+        self.format = format
+        self.queue_size = queue_size
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.sample_every = sample_every
+        # events left out, by a full queue or the rate limit
+        self.dropped = 0
+        self.suppressed = 0
+
+        self._queue = collections.deque()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def log(self, level, event, rate_key=None, **fields):
+        """
+        Queues an event, returns straight away.
+        rate_key: events of one name and different keys, e.g. one per
+            host, are rate limited apart
+        """
+        if level < self.level:
+            return
+        now = time.time()
+        with self._lock:
+            if self.rate_per_s:
+                suppressed = self._limit(event if rate_key is None else (event, rate_key), now)
+                if suppressed is None:
+                    return
+                if suppressed:
+                    fields["suppressed"] = suppressed
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+                return
+            self._queue.append((now, level, event, fields))
+        self._wake.set()
+
+    def _limit(self, key, now):
+        # Returns None to leave the event out, or the number of events of
+        # its key left out before it
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(now, self.burst)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate_per_s)
+        bucket.updated = now
+        if bucket.tokens < 1 and bucket.suppressed + 1 < self.sample_every:
+            bucket.suppressed += 1
+            self.suppressed += 1
+            return None
+        bucket.tokens = max(bucket.tokens - 1, 0)
+        suppressed = bucket.suppressed
+        bucket.suppressed = 0
+        return suppressed
+
+    def format_event(self, t, level, event, fields):
+        if self.format == JSON:
+            record = {"time": t, "level": LEVEL_NAMES.get(level, level), "event": event}
+            for name, value in fields.items():
+                record[name] = _plain(value)
+            return json.dumps(record)
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        parts = ["{}.{:03d}".format(stamp, int(t * 1000) % 1000), LEVEL_NAMES.get(level, str(level)), event]
+        parts.extend("{}={}".format(name, _format_value(value)) for name, value in fields.items())
+        return " ".join(parts)
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._flush()
+            if self._stopping:
+                self._flush()
+                return
+
+    def _flush(self):
+        lines = []
+        while self._queue:
+            lines.append(self.format_event(*self._queue.popleft()))
+        if not lines:
+            return
+        out = self.out or sys.stderr
+        try:
+            out.write("\n".join(lines) + "\n")
+            out.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def close(self):
+        """
+        Writes what is queued and stops the writer.
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._writer.join()
+
+LOG = EventLog()
+atexit.register(LOG.close)
+
+def debug(event, rate_key=None, **fields):
+    LOG.log(DEBUG, event, rate_key, **fields)
+
+def info(event, rate_key=None, **fields):
+    LOG.log(INFO, event, rate_key, **fields)
+
+def warning(event, rate_key=None, **fields):
+    LOG.log(WARNING, event, rate_key, **fields)
+
+def error(event, rate_key=None, **fields):
+    LOG.log(ERROR, event, rate_key, **fields)
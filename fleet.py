@@ -0,0 +1,288 @@
+"""
+Fleet mode: one process polling the sensors of many greenhouses, each a
+Pi running pigpiod.
+
+    python fleet.py fleet.json
+
+fleet.json lists the greenhouses:
+    [{"name": "north", "host": "192.168.1.20", "port": 8888}, ...]
+"""
+import concurrent.futures
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import numpy as np
+import pigpio
+import backend
+import events
+import greenhouse
+import history
+import metrics
+import notify
+import sensor_log
+from mcp3008 import MCP3008
+from my_dht11 import DHT11
+from sensor_log import SensorLog
+
+POLL_INTERVAL_S = 1.0
+# reconnect after 1, 2, 4 ... seconds, at most every RECONNECT_MAX_S
+RECONNECT_MIN_S = 1.0
+RECONNECT_MAX_S = 60.0
+RECONNECT_JITTER = 0.2
+
+# What a broken connection to pigpiod raises
+CONNECTION_ERRORS = backend.CONNECTION_ERRORS
+
+POLLS = metrics.counter("greenhouse_fleet_polls_total", "Polls of each greenhouse by result",
+                        ("host", "result"))
+POLL_SECONDS = metrics.histogram("greenhouse_fleet_poll_seconds", "Time to poll a greenhouse",
+                                 ("host",))
+CONNECTED = metrics.gauge("greenhouse_fleet_connected", "1 while connected to the greenhouse",
+                          ("host",))
+
+class Host(object):
+    def __init__(self, name, host=None, port=None, backend_name=None):
+        """
+        One greenhouse of the fleet. Its pigpio connection and sensors are
+        set up on the first poll, reused by every poll after, and set up
+        again after a connection error once the backoff has passed.
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.backend_name = backend_name
+        self.pi = None
+        self.mcp3008 = None
+        self.inside_dht11 = None
+        self.outside_dht11 = None
+        self.edge_capture = None
+        self.row = np.full(history.NUM_COLUMNS, np.nan)
+        self.sensor_log = SensorLog(os.path.join(sensor_log.LOG_DIR, name))
+
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self._ok = POLLS.labels(name, "ok")
+        self._failed = POLLS.labels(name, "failed")
+        self._skipped = POLLS.labels(name, "backoff")
+        self._seconds = POLL_SECONDS.labels(name)
+        self._connected = CONNECTED.labels(name)
+
+    @property
+    def connected(self):
+        return self.pi is not None
+
+    def _connect(self):
+        pi = backend.connect(self.host, self.port, self.backend_name, show_errors=False)
+        if not pi.connected:
+            pi.stop()
+            raise pigpio.error("cannot connect to pigpiod on {}".format(self.host or "localhost"))
+        self.pi = pi
+        try:
+            try:
+                self.edge_capture = notify.EdgeCapture(pi)
+            except CONNECTION_ERRORS as e:
+                events.warning("fleet.no_notification_stream", rate_key=self.name, host=self.name, error=e)
+            self.inside_dht11 = DHT11(pi, greenhouse.PIN_DHT11_INSIDE, self.edge_capture, self.name)
+            self.outside_dht11 = DHT11(pi, greenhouse.PIN_DHT11_OUTSIDE, self.edge_capture, self.name)
+            pi.set_mode(greenhouse.PIN_LIGHTGATE, pigpio.INPUT)
+            self.mcp3008 = MCP3008(pi, spi_channel=0, baud=1000000, spi_flags=0)
+            # the DHT11s are slow, read them on their own threads
+            self.inside_dht11.start(greenhouse.DHT11_READ_INTERVAL_S)
+            self.outside_dht11.start(greenhouse.DHT11_READ_INTERVAL_S)
+        except CONNECTION_ERRORS:
+            self.disconnect()
+            raise
+        self._connected.set(1)
+
+    def disconnect(self):
+        """
+        Drops the connection and the sensors on it.
+        """
+        for closeable in (self.inside_dht11, self.outside_dht11, self.edge_capture, self.mcp3008):
+            if closeable is not None:
+                try:
+                    closeable.close()
+                except CONNECTION_ERRORS:
+                    pass
+        if self.pi is not None:
+            try:
+                self.pi.stop()
+            except CONNECTION_ERRORS:
+                pass
+        self.pi = self.mcp3008 = self.inside_dht11 = self.outside_dht11 = self.edge_capture = None
+        self._connected.set(0)
+
+    def poll(self, now):
+        """
+        Takes a row of readings, connecting first if needed. Returns the
+        row (a NumPy array, NaN where missing), or None if the host is
+        unreachable or waiting to be retried.
+        """
+        if now < self.retry_at:
+            self._skipped.inc()
+            return None
+        started = time.time()
+        try:
+            if self.pi is None:
+                self._connect()
+            row = self._read()
+        except CONNECTION_ERRORS as e:
+            self.disconnect()
+            self.failures += 1
+            self.last_error = e
+            # exponential backoff, with jitter so hosts lost together do
+            # not all retry together
+            delay = min(RECONNECT_MIN_S * 2 ** (self.failures - 1), RECONNECT_MAX_S)
+            self.retry_at = time.time() + delay * random.uniform(1 - RECONNECT_JITTER, 1 + RECONNECT_JITTER)
+            self._failed.inc()
+            events.error("fleet.poll_failed", rate_key=self.name, host=self.name, error=e,
+                         retry_s=round(self.retry_at - time.time(), 1))
+            return None
+        self.failures = 0
+        self.last_error = None
+        self._ok.inc()
+        self._seconds.observe(time.time() - started)
+        return row
+
+    def _read(self):
+        moisture = self.mcp3008.read_channels(oversample=greenhouse.MOISTURE_OVERSAMPLE,
+                                              method=greenhouse.MOISTURE_FILTER)
+        row = self.row
+        row[history.MOISTURE] = moisture
+        row[history.INSIDE_TEMPERATURE], row[history.INSIDE_HUMIDITY] = \
+            greenhouse.dht11_values(self.inside_dht11.reading())
+        row[history.OUTSIDE_TEMPERATURE], row[history.OUTSIDE_HUMIDITY] = \
+            greenhouse.dht11_values(self.outside_dht11.reading())
+        row[history.LIGHTGATE] = self.pi.read(greenhouse.PIN_LIGHTGATE)
+        self.sensor_log.append(time.time(), row)
+        return row.copy()
+
+    def close(self):
+        self.disconnect()
+        self.sensor_log.close()
+
+class Fleet(object):
+    def __init__(self, hosts, poll_interval=POLL_INTERVAL_S, max_workers=None, on_reading=None):
+        """
+        Polls every host of the fleet concurrently on a thread pool, so a
+        round takes as long as the slowest host rather than all of them.
+        A host still busy with its last poll is not polled again.
+        hosts (list of Host): the greenhouses
+        on_reading(host, t, row): called from the pool for every poll that
+            returned readings
+        """
+        self.hosts = list(hosts)
+        self.poll_interval = poll_interval
+        self.on_reading = on_reading
+        self.latest = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(len(self.hosts), 1))
+        self._pending = {}
+        self._stop_event = threading.Event()
+        self._poller = None
+
+    def poll_once(self, now=None):
+        """
+        Starts a poll of every host that is not still being polled and
+        returns their futures.
+        """
+        now = time.time() if now is None else now
+        futures = []
+        for host in self.hosts:
+            future = self._pending.get(host.name)
+            if future is not None and not future.done():
+                continue
+            future = self._executor.submit(self._poll, host, now)
+            self._pending[host.name] = future
+            futures.append(future)
+        return futures
+
+    def _poll(self, host, now):
+        row = host.poll(now)
+        if row is not None:
+            t = time.time()
+            self.latest[host.name] = (t, row)
+            if self.on_reading is not None:
+                self.on_reading(host, t, row)
+        return row
+
+    def start(self):
+        if self._poller is not None:
+            return
+        self._stop_event.clear()
+        self._poller = threading.Thread(target=self._run)
+        self._poller.daemon = True
+        self._poller.start()
+
+    def stop(self):
+        if self._poller is not None:
+            self._stop_event.set()
+            self._poller.join()
+            self._poller = None
+        self._executor.shutdown(wait=True)
+        for host in self.hosts:
+            host.close()
+
+    def _run(self):
+        next_round = time.time()
+        while not self._stop_event.is_set():
+            self.poll_once(next_round)
+            next_round += self.poll_interval
+            delay = next_round - time.time()
+            if delay < 0:
+                next_round = time.time()
+                delay = 0
+            self._stop_event.wait(delay)
+
+def load_hosts(path):
+    """
+    Returns the Hosts listed in a fleet JSON file.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return [Host(entry["name"], entry.get("host"), entry.get("port"), entry.get("backend"))
+            for entry in entries]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python fleet.py fleet.json")
+        return 2
+
+    hosts = load_hosts(argv[0])
+    if not hosts:
+        print("{} lists no greenhouses".format(argv[0]))
+        return 2
+    # the readings are the output, every one of every host, written to
+    # stdout on the event log's writer thread so a slow pipe does not
+    # hold up the pool
+    readings = events.EventLog(out=sys.stdout, level=events.INFO, rate_per_s=0)
+
+    def on_reading(host, t, row):
+        readings.log(events.INFO, "fleet.reading", host=host.name, row=row)
+
+    fleet = Fleet(hosts, on_reading=on_reading)
+    metrics_server = metrics.MetricsServer()
+    fleet.start()
+    try:
+        metrics_server.start()
+    except OSError as e:
+        events.error("metrics.not_started", error=e)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1.0):
+        pass
+
+    metrics_server.stop()
+    fleet.stop()
+    readings.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+"""
+The greenhouse itself: sensors, lamp, fan and pump control and the door,
+without any user interface. Run it as a headless daemon with
+
+    python greenhouse.py
+
+and attach any number of user interfaces (ui.py) over its local socket.
+"""
+import datetime
+import math
+import signal
+import threading
+import time
+import numpy as np
+import pigpio
+import backend
+import clock
+import events
+import history
+import mcp3008
+import metrics
+import motion_profile
+import notify
+from control import ControlEngine, Actuator, Hysteresis, Schedule, OFF, ON, AUTO
+from door import DoorController, DIR_CLOSING
+from history import History
+from lightgate import Lightgate
+from mcp3008 import MCP3008
+from outputs import OutputBank
+from my_dht11 import DHT11
+from sensor_cache import SensorCache
+from sensor_log import SensorLog
+
+PIN_STEP = 21
+PIN_ENN = 16
+PIN_DIR = 20
+PIN_LAMP = 26
+PIN_FAN = 13
+PIN_PUMP = 19
+PIN_DHT11_INSIDE = 12
+PIN_DHT11_OUTSIDE = 17
+PIN_LIGHTGATE = 5
+# the lightgate at the closed end reads this while the door blocks it
+LIGHTGATE_CLOSED_LEVEL = 0
+
+SAMPLE_INTERVAL_S = 0.2
+DHT11_READ_INTERVAL_S = 1.0
+# get the DHT11 frames in bulk through a pigpio notification stream rather
+# than one callback per edge, which loses edges on a busy Pi
+DHT11_BULK_CAPTURE = True
+# readings per moisture channel and tick, combined with MOISTURE_FILTER
+MOISTURE_OVERSAMPLE = 4
+MOISTURE_FILTER = mcp3008.MEDIAN
+# every sampling tick takes a new moisture reading, the control loop
+# uses the tick's unless it is older than a control period
+MOISTURE_CACHE_TTL_S = SAMPLE_INTERVAL_S / 2
+# after failing reads the last good moisture is used for this long
+MOISTURE_MAX_AGE_S = 3.0
+
+CONTROL_PERIOD_S = 1.0
+LAMP_ON_TIME = datetime.time(6, 0)
+LAMP_OFF_TIME = datetime.time(22, 0)
+LAMP_MIN_SWITCH_S = 60.0
+FAN_ON_ABOVE_C = 28.0
+FAN_OFF_BELOW_C = 26.0
+FAN_MIN_SWITCH_S = 60.0
+# moisture readings rise as the soil dries out
+PUMP_ON_ABOVE = 700
+PUMP_OFF_BELOW = 500
+PUMP_MIN_ON_S = 5.0
+PUMP_MIN_OFF_S = 600.0 # let the water soak in before watering again
+
+ACCELERATION_MS2 = 0.4
+MAX_VELOCITY_MS = 0.2
+HEIGHT_M = 0.335
+STEPS_PER_REV = 1600.0
+PULLEY_DIAMETER_M = 0.012 * (21.3 / 20.0)
+MOTION_PROFILE = motion_profile.TRAPEZOIDAL
+JERK_MS3 = 4.0 # only used by s-curve profiles
+
+PULLEY_CIRCUMF_M = PULLEY_DIAMETER_M * math.pi
+STEPS_PER_M = STEPS_PER_REV / PULLEY_CIRCUMF_M
+TOTAL_STEPS = HEIGHT_M * STEPS_PER_M
+
+OUTPUTS = ("lamp", "fan", "pump")
+
+TICK_SECONDS = metrics.histogram("greenhouse_tick_seconds", "Time spent in a sampling tick")
+TICK_JITTER = metrics.histogram("greenhouse_tick_jitter_seconds",
+                                "How late a sampling tick started against its period")
+TICK_PIGPIO_CALLS = metrics.histogram("greenhouse_tick_pigpio_calls",
+                                      "pigpio calls made during a sampling tick, all threads",
+                                      buckets=metrics.COUNT_BUCKETS)
+
+def dht11_values(reading):
+    """
+    Returns (temperature, humidity) of a DHT11 reading, the last good
+    values until they go stale and NaN after.
+    """
+    if reading.value is None or reading.stale:
+        return np.nan, np.nan
+    return reading.value.temperature, reading.value.humidity
+
+def reading_state(reading):
+    return {"time": reading.timestamp, "valid": reading.valid, "stale": reading.stale}
+
+def driest_moisture(readings):
+    values = [readings["moisture_{}".format(i)] for i in range(8) if "moisture_{}".format(i) in readings]
+    return max(values) if values else None
+
+class Greenhouse(object):
+    def __init__(self, pi=None, log_dir=None):
+        """
+        Sets up the sensors, outputs and door. Nothing runs until start().
+        State is published to subscribers as a dict after every sampling
+        tick and every change made through this object, see snapshot().
+        pi (pigpio): connection to use, backend.connect() when None,
+            recording to GREENHOUSE_RECORD if set
+        log_dir (str): where to keep the sensor log, GREENHOUSE_LOG_DIR
+            when None
+        """
+        if pi is None:
+            pi = backend.connect(record=backend.RECORD_PATH)
+        if getattr(pi, "auto_sensors", False):
+            # simulated hardware, the lightgate follows the simulated door
+            pi.add_door(PIN_STEP, PIN_DIR, PIN_LIGHTGATE, LIGHTGATE_CLOSED_LEVEL, DIR_CLOSING)
+        # the user's actions go into a recording with the traffic
+        self._record_action = getattr(pi, "record_action", None)
+        self.pi = metrics.CountingPi(pi)
+        # simulated hardware may run faster than real time, and so does
+        # everything timed here
+        self.clock = clock.of(pi)
+
+        # keep a fixed size history of every reading
+        self.history = History()
+        self.history_row = np.full(history.NUM_COLUMNS, np.nan)
+        # time the row was sampled
+        self.row_time = None
+        # and log it to disk for the long run
+        self.sensor_log = SensorLog() if log_dir is None else SensorLog(log_dir)
+
+        # the lamp, fan, pump and door motor outputs, written in batches
+        self.outputs = OutputBank(self.pi)
+        self.control = ControlEngine(self.read_control_inputs, period_s=CONTROL_PERIOD_S,
+                                     clock=self.clock)
+        self.control.add("lamp", Actuator(self.pi, PIN_LAMP, LAMP_MIN_SWITCH_S, LAMP_MIN_SWITCH_S, self.outputs),
+                         Schedule(LAMP_ON_TIME, LAMP_OFF_TIME))
+        self.control.add("fan", Actuator(self.pi, PIN_FAN, FAN_MIN_SWITCH_S, FAN_MIN_SWITCH_S, self.outputs),
+                         Hysteresis("inside_temperature", on_above=FAN_ON_ABOVE_C, off_below=FAN_OFF_BELOW_C))
+        self.control.add("pump", Actuator(self.pi, PIN_PUMP, PUMP_MIN_ON_S, PUMP_MIN_OFF_S, self.outputs),
+                         Hysteresis(driest_moisture, on_above=PUMP_ON_ABOVE, off_below=PUMP_OFF_BELOW))
+
+        self.edge_capture = None
+        if DHT11_BULK_CAPTURE:
+            try:
+                self.edge_capture = notify.EdgeCapture(self.pi)
+            except (pigpio.error, OSError) as e:
+                events.warning("greenhouse.no_notification_stream", error=e)
+        self.inside_dht11 = DHT11(self.pi, PIN_DHT11_INSIDE, self.edge_capture)
+        self.outside_dht11 = DHT11(self.pi, PIN_DHT11_OUTSIDE, self.edge_capture)
+        # followed by edge callback, it stops closing moves at the closed end
+        self.lightgate = Lightgate(self.pi, PIN_LIGHTGATE, blocked_level=LIGHTGATE_CLOSED_LEVEL)
+        self.mcp3008 = MCP3008(self.pi, spi_channel=0, baud=1000000, spi_flags=0)
+        self.moisture = SensorCache("moisture", self.read_moisture, ttl=MOISTURE_CACHE_TTL_S,
+                                    max_age=MOISTURE_MAX_AGE_S, clock=self.clock)
+
+        self.door = DoorController(self.pi, PIN_STEP, PIN_DIR, PIN_ENN, TOTAL_STEPS, STEPS_PER_M,
+                                   ACCELERATION_MS2, MAX_VELOCITY_MS,
+                                   on_progress=self.on_door_progress,
+                                   on_finished=self.on_door_finished,
+                                   profile_kind=MOTION_PROFILE, jerk_ms3=JERK_MS3,
+                                   lightgate=self.lightgate, bank=self.outputs)
+        self.door_progress = None
+
+        self.state = None
+        self._listeners = []
+        self._publish_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+
+        metrics.gauge("greenhouse_control_jitter_seconds_max", "Latest start of a control cycle",
+                      function=lambda: self.control.max_jitter)
+        metrics.gauge("greenhouse_control_jitter_seconds_mean", "Mean lateness of control cycles",
+                      function=lambda: self.control.mean_jitter)
+        metrics.gauge("greenhouse_sensor_log_dropped", "Rows the sensor log had no room for",
+                      function=lambda: self.sensor_log.dropped)
+        metrics.gauge("greenhouse_events_dropped", "Events the event log had no room for",
+                      function=lambda: events.LOG.dropped)
+        metrics.gauge("greenhouse_events_suppressed", "Events left out by the event log's rate limit",
+                      function=lambda: events.LOG.suppressed)
+
+    def start(self):
+        """
+        Starts reading the sensors, the control loop and the sampling tick.
+        """
+        if self._sampler is not None:
+            return
+        # read the DHT11s on their own worker threads, the tick only
+        # picks up the published samples
+        self.inside_dht11.start(DHT11_READ_INTERVAL_S)
+        self.outside_dht11.start(DHT11_READ_INTERVAL_S)
+        self.control.start()
+        self._stop_event.clear()
+        self._sampler = threading.Thread(target=self._run)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stops everything started and the door, and flushes the sensor log.
+        """
+        if self._sampler is not None:
+            self._stop_event.set()
+            self._sampler.join()
+            self._sampler = None
+        self.door.cancel()
+        self.lightgate.close()
+        self.inside_dht11.close()
+        self.outside_dht11.close()
+        if self.edge_capture is not None:
+            self.edge_capture.close()
+        self.control.stop()
+        self.sensor_log.close()
+
+    def subscribe(self, listener):
+        """
+        Calls listener(state) with every new state, from whichever thread
+        made the change. Listeners must return quickly.
+        """
+        with self._publish_lock:
+            self._listeners = self._listeners + [listener]
+
+    def unsubscribe(self, listener):
+        with self._publish_lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    def set_mode(self, name, mode):
+        """
+        Sets output name ("lamp", "fan" or "pump") to OFF, ON or AUTO.
+        """
+        if name not in OUTPUTS:
+            raise ValueError("unknown output {}".format(name))
+        if mode not in (OFF, ON, AUTO):
+            raise ValueError("unknown mode {}".format(mode))
+        self._action("set_mode", name=name, mode=mode)
+        self.control.set_mode(name, mode)
+        self.publish()
+
+    def toggle_door(self):
+        # opens or closes the door, or reverses it while it is moving
+        self._action("toggle_door")
+        self.door.toggle()
+        self.publish()
+
+    def cancel_door(self):
+        self._action("cancel_door")
+        self.door.cancel()
+        self.publish()
+
+    def _action(self, action, **arguments):
+        if self._record_action is not None:
+            self._record_action(action, **arguments)
+
+    # The door controller calls these from its own thread
+    def on_door_progress(self, door, progress):
+        self.door_progress = progress
+        self.publish()
+
+    def on_door_finished(self, door):
+        self.door_progress = None
+        self.publish()
+
+    def read_moisture(self):
+        # all channels in one round-trip to pigpiod
+        return self.mcp3008.read_channels(oversample=MOISTURE_OVERSAMPLE, method=MOISTURE_FILTER)
+
+    def read_control_inputs(self):
+        # called from the control thread, stale readings are left out so
+        # the rules hold their outputs rather than act on them
+        readings = {}
+        inside = self.inside_dht11.reading()
+        if inside.value is not None and not inside.stale:
+            readings["inside_temperature"] = inside.value.temperature
+            readings["inside_humidity"] = inside.value.humidity
+        outside = self.outside_dht11.reading()
+        if outside.value is not None and not outside.stale:
+            readings["outside_temperature"] = outside.value.temperature
+            readings["outside_humidity"] = outside.value.humidity
+        moisture = self.moisture.get(ttl=CONTROL_PERIOD_S)
+        if moisture.value is not None and not moisture.stale:
+            for i in range(8):
+                readings["moisture_{}".format(i)] = moisture.value[i]
+        return readings
+
+    def sample(self):
+        """
+        Takes one row of readings into the history and the sensor log.
+        """
+        moisture = self.moisture.get()
+        events.debug("greenhouse.moisture", values=moisture.value)
+        lightgate = self.lightgate.level
+
+        row = self.history_row
+        row[history.MOISTURE] = moisture.value if not moisture.stale else np.nan
+        row[history.INSIDE_TEMPERATURE], row[history.INSIDE_HUMIDITY] = \
+            dht11_values(self.inside_dht11.reading())
+        row[history.OUTSIDE_TEMPERATURE], row[history.OUTSIDE_HUMIDITY] = \
+            dht11_values(self.outside_dht11.reading())
+        row[history.LIGHTGATE] = lightgate
+        now = self.clock.time()
+        self.row_time = now
+        self.history.add(now, row)
+        self.sensor_log.append(now, row)
+        self.publish(now)
+
+    def snapshot(self, now=None):
+        """
+        Returns the current state as a dict of plain values:
+        time, row (the last history row as a list, NaN where missing),
+        row_time (when row was sampled, None before the first),
+        modes and outputs of the lamp, fan and pump, and door with its
+        position (DOOR_*), moving, direction and progress (None when idle),
+        and sensors, the capture time, valid and stale flags of the
+        readings in row.
+        """
+        now = self.clock.time() if now is None else now
+        actuators = self.control.actuators
+        return {
+            "time": now,
+            "row": self.history_row.tolist(),
+            "row_time": self.row_time,
+            "modes": dict((name, actuators[name].mode) for name in OUTPUTS),
+            "outputs": dict((name, actuators[name].state) for name in OUTPUTS),
+            "door": {
+                "position": self.door.door_position,
+                "moving": self.door.moving,
+                "direction": self.door.direction,
+                "progress": self.door_progress,
+            },
+            "sensors": {
+                "moisture": reading_state(self.moisture.peek(now)),
+                "inside_dht11": reading_state(self.inside_dht11.reading(now)),
+                "outside_dht11": reading_state(self.outside_dht11.reading(now)),
+            },
+        }
+
+    def publish(self, now=None):
+        state = self.snapshot(now)
+        self.state = state
+        for listener in self._listeners:
+            listener(state)
+
+    def _run(self):
+        clock = self.clock
+        next_tick = clock.time()
+        while True:
+            delay = next_tick - clock.time()
+            if delay > 0 and clock.wait(self._stop_event, delay):
+                return
+            if self._stop_event.is_set():
+                return
+            TICK_JITTER.observe(clock.time() - next_tick)
+            started = time.time()
+            calls = self.pi.calls
+
+            try:
+                self.sample()
+            except backend.CONNECTION_ERRORS as e:
+                events.error("greenhouse.sampling_failed", error=e)
+
+            TICK_PIGPIO_CALLS.observe(self.pi.calls - calls)
+            TICK_SECONDS.observe(time.time() - started)
+            next_tick += SAMPLE_INTERVAL_S
+            if next_tick < clock.time():
+                # Overran whole periods, skip them rather than catch up
+                next_tick = clock.time() + SAMPLE_INTERVAL_S
+
+def main():
+    import remote
+
+    events.info("greenhouse.starting", total_steps=TOTAL_STEPS)
+    greenhouse = Greenhouse()
+    server = remote.Server(greenhouse)
+    metrics_server = metrics.MetricsServer()
+    greenhouse.start()
+    server.start()
+    try:
+        metrics_server.start()
+    except OSError as e:
+        events.error("metrics.not_started", error=e)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1.0):
+        pass
+
+    server.stop()
+    metrics_server.stop()
+    greenhouse.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import threading
+import numpy as np
+
+# Columns of a history row
+MOISTURE = slice(0, 8)
+INSIDE_TEMPERATURE = 8
+INSIDE_HUMIDITY = 9
+OUTSIDE_TEMPERATURE = 10
+OUTSIDE_HUMIDITY = 11
+LIGHTGATE = 12
+NUM_COLUMNS = 13
+
+COLUMN_NAMES = ["moisture_{}".format(i) for i in range(8)] + [
+    "inside_temperature", "inside_humidity",
+    "outside_temperature", "outside_humidity",
+    "lightgate",
+]
+
+# Default retention of each tier, raw assumes the 200 ms sampling tick
+# and holds twice the UI's hour long plot, which then stays on raw rows
+RAW_CAPACITY = 2 * 5 * 60 * 60    # 2 hours
+MINUTE_CAPACITY = 60 * 24 * 7     # 1 week
+HOUR_CAPACITY = 24 * 366          # 1 year
+
+class RingBuffer(object):
+    def __init__(self, capacity, shape):
+        """
+        Fixed size ring of timestamped rows, the oldest row is overwritten
+        once it is full.
+        capacity (int): number of rows kept
+        shape (tuple): shape of a row
+        """
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.full((capacity,) + tuple(shape), np.nan, dtype=np.float32)
+        self.start = 0
+        self.count = 0
+
+    def append(self, t, row):
+        idx = (self.start + self.count) % self.capacity
+        self.times[idx] = t
+        self.values[idx] = row
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def _time_at(self, i):
+        return self.times[(self.start + i) % self.capacity]
+
+    def since(self, t):
+        """
+        Returns (times, values) of the rows at or after t, oldest first.
+        Costs O(log n) to find the window plus O(window) to copy it out.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.last(self.count - lo)
+
+    def last(self, n):
+        """
+        Returns (times, values) of the last n rows, oldest first.
+        """
+        n = min(n, self.count)
+        first = (self.start + self.count - n) % self.capacity
+        end = first + n
+        if end <= self.capacity:
+            return self.times[first:end].copy(), self.values[first:end].copy()
+        end -= self.capacity
+        return (np.concatenate((self.times[first:], self.times[:end])),
+                np.concatenate((self.values[first:], self.values[:end])))
+
+class _Bucket(object):
+    """
+    Running min/sum/max/count of the rows of one downsampling period.
+    """
+    def __init__(self, num_columns):
+        self.start = None
+        self.min = np.full(num_columns, np.nan)
+        self.max = np.full(num_columns, np.nan)
+        self.sum = np.zeros(num_columns)
+        self.count = np.zeros(num_columns)
+
+    def reset(self, start):
+        self.start = start
+        self.min.fill(np.nan)
+        self.max.fill(np.nan)
+        self.sum.fill(0)
+        self.count.fill(0)
+
+    def add(self, mins, means, maxs, counts):
+        valid = counts > 0
+        np.fmin(self.min, mins, out=self.min)
+        np.fmax(self.max, maxs, out=self.max)
+        self.sum[valid] += means[valid] * counts[valid]
+        self.count += counts
+
+    def row(self):
+        """
+        Returns a (4, columns) row of min, mean, max and sample count.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count > 0, self.sum / self.count, np.nan)
+        return np.array([self.min, mean, self.max, self.count])
+
+def _append(times, values, periods):
+    # (times, values) with the (start, row) periods not closed yet
+    periods = [(t, row) for t, row in periods if not len(times) or t > times[-1]]
+    if not periods:
+        return times, values
+    return (np.append(times, [t for t, row in periods]),
+            np.concatenate((values, np.array([row for t, row in periods], dtype=values.dtype))))
+
+class History(object):
+    def __init__(self, raw_capacity=RAW_CAPACITY, minute_capacity=MINUTE_CAPACITY,
+                 hour_capacity=HOUR_CAPACITY):
+        """
+        In-memory sensor history with downsampled tiers. Memory is fixed
+        when it is created, however long the process runs.
+        raw: every row as added
+        minutes, hours: (min, mean, max, count) of each minute and hour
+        Missing readings are NaN and do not count towards the aggregates.
+        """
+        self.raw = RingBuffer(raw_capacity, (NUM_COLUMNS,))
+        self.minutes = RingBuffer(minute_capacity, (4, NUM_COLUMNS))
+        self.hours = RingBuffer(hour_capacity, (4, NUM_COLUMNS))
+        self._minute = _Bucket(NUM_COLUMNS)
+        self._hour = _Bucket(NUM_COLUMNS)
+        self._missing = np.empty(NUM_COLUMNS, dtype=bool)
+        self._counts = np.empty(NUM_COLUMNS)
+        self._lock = threading.Lock()
+
+    def add(self, t, row):
+        """
+        Adds a row of NUM_COLUMNS readings taken at time t (seconds since
+        the epoch), NaN for readings that are missing.
+        """
+        row = np.asarray(row, dtype=np.float64)
+        with self._lock:
+            self.raw.append(t, row)
+
+            minute = t - t % 60
+            if self._minute.start != minute:
+                if self._minute.start is not None:
+                    self._close_minute()
+                self._minute.reset(minute)
+            np.isnan(row, out=self._missing)
+            np.subtract(1.0, self._missing, out=self._counts)
+            self._minute.add(row, row, row, self._counts)
+
+    def _close_minute(self):
+        row = self._minute.row()
+        self.minutes.append(self._minute.start, row)
+
+        hour = self._minute.start - self._minute.start % 3600
+        if self._hour.start != hour:
+            if self._hour.start is not None:
+                self.hours.append(self._hour.start, self._hour.row())
+            self._hour.reset(hour)
+        self._hour.add(row[0], row[1], row[2], row[3])
+
+    def query(self, seconds, now):
+        """
+        Returns the finest tier covering the last seconds before now as
+        (tier, times, values), tier being "raw", "minutes" or "hours".
+        Raw values have one column per reading, the other tiers have
+        (min, mean, max, count) rows per reading, from the period
+        reaching back over the start of the window to the one still
+        being filled.
+        """
+        start = now - seconds
+        with self._lock:
+            if self.raw.count < self.raw.capacity or self.raw._time_at(0) <= start:
+                times, values = self.raw.since(start)
+                return "raw", times, values
+            if self.minutes.count < self.minutes.capacity or self.minutes._time_at(0) <= start - 60:
+                times, values = self.minutes.since(start - 60)
+                return ("minutes",) + _append(times, values, self._open_minutes())
+            times, values = self.hours.since(start - 3600)
+            return ("hours",) + _append(times, values, self._open_hours())
+
+    def _open_minutes(self):
+        if self._minute.start is None:
+            return []
+        return [(self._minute.start, self._minute.row())]
+
+    def _open_hours(self):
+        # the hour being filled from the closed minutes and the open one,
+        # which may have started the next hour
+        if self._minute.start is None:
+            return []
+        minute_hour = self._minute.start - self._minute.start % 3600
+        if self._hour.start is None:
+            return [(minute_hour, self._minute.row())]
+        if self._hour.start != minute_hour:
+            return [(self._hour.start, self._hour.row()), (minute_hour, self._minute.row())]
+        hour = _Bucket(NUM_COLUMNS)
+        hour.reset(minute_hour)
+        hour.add(*self._hour.row())
+        hour.add(*self._minute.row())
+        return [(minute_hour, hour.row())]
+
+    def latest_time(self):
+        """
+        Time of the newest row, None before the first.
+        """
+        with self._lock:
+            if not self.raw.count:
+                return None
+            return self.raw._time_at(self.raw.count - 1)
+
+    def last_raw(self, seconds, now):
+        with self._lock:
+            return self.raw.since(now - seconds)
+
+    def last_minutes(self, seconds, now):
+        with self._lock:
+            return self.minutes.since(now - seconds)
+
+    def last_hours(self, seconds, now):
+        with self._lock:
+            return self.hours.since(now - seconds)
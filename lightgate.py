@@ -0,0 +1,78 @@
+import threading
+import pigpio
+import clock
+import metrics
+
+# Edges shorter than this (µs) are ignored by pigpiod
+GLITCH_FILTER_US = 100
+
+EDGES = metrics.counter("greenhouse_lightgate_edges_total", "Lightgate level changes",
+                        ("gpio",))
+
+class Lightgate(object):
+    def __init__(self, pi, gpio, blocked_level=0, glitch_us=GLITCH_FILTER_US):
+        """
+        Follows a lightgate by edge callback, each change timestamped with
+        pigpio's hardware tick, rather than by polling its level.
+        pi (pigpio): an instance of pigpio
+        gpio (int): gpio pin number
+        blocked_level (int): level read while the beam is broken
+        glitch_us (int): edges steady for less than this are ignored
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.blocked_level = blocked_level
+        self.clock = clock.of(pi)
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._edges = EDGES.labels(gpio)
+
+        self.pi.set_mode(gpio, pigpio.INPUT)
+        if glitch_us:
+            self.pi.set_glitch_filter(gpio, glitch_us)
+        self.level = self.pi.read(gpio)
+        # tick and wall clock time of the last change, or of the start
+        self.tick = self.pi.get_current_tick()
+        self.changed_at = self.clock.time()
+        self._cb = self.pi.callback(gpio, pigpio.EITHER_EDGE, self._on_edge)
+
+    @property
+    def blocked(self):
+        return self.level == self.blocked_level
+
+    def subscribe(self, listener):
+        """
+        Calls listener(blocked, tick) from pigpio's callback thread on
+        every change. Listeners must return quickly, edges queue up
+        behind them.
+        """
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    def _on_edge(self, gpio, level, tick):
+        # level 2 is a watchdog timeout, not a change
+        if level == pigpio.TIMEOUT or level == self.level:
+            return
+        self.level = level
+        self.tick = tick
+        self.changed_at = self.clock.time()
+        self._edges.inc()
+        blocked = level == self.blocked_level
+        for listener in self._listeners:
+            listener(blocked, tick)
+
+    def tick_time(self, tick):
+        """
+        Time of a pigpio tick in the last 71 minutes, by the clock of pi.
+        """
+        return self.clock.time() - ((self.pi.get_current_tick() - tick) & 0xffffffff) / 1000000.0
+
+    def close(self):
+        if self._cb is not None:
+            self._cb.cancel()
+            self._cb = None
+        self.pi.set_glitch_filter(self.gpio, 0)
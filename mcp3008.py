@@ -0,0 +1,129 @@
+import struct
+import time
+import numpy as np
+import pigpio
+import metrics
+
+NUM_CHANNELS = 8
+ALL_CHANNELS = tuple(range(NUM_CHANNELS))
+
+# Ways to combine oversampled readings
+MEAN = "mean"
+MEDIAN = "median"
+
+# pigpio socket command transferring bytes over SPI
+_PI_CMD_SPIX = 75
+_SOCK_CMD_LEN = 16
+
+SPI_SECONDS = metrics.histogram("greenhouse_spi_transfer_seconds",
+                                "Time of a round-trip of SPI transfers to pigpiod", ("transfers",))
+
+def _command(channel):
+    # start bit, single ended mode and channel, then clock out the result
+    return bytearray([1, (8 + channel) << 4, 0])
+
+def _value(adc):
+    return ((adc[1] & 3) << 8) + adc[2]
+
+class MCP3008(object):
+    def __init__(self, pi, spi_channel=0, baud=1000000, spi_flags=0):
+        """
+        pi (pigpio): an instance of pigpio
+        spi_channel (int): SPI chip select the MCP3008 is on
+        """
+        self.pi = pi
+        self.handle = self.pi.spi_open(spi_channel=spi_channel, baud=baud, spi_flags=spi_flags)
+        self._requests = {}
+        self._spi_seconds = {}
+
+    def read(self, channel):
+        """
+        Reads a single channel 0-7, one SPI transfer.
+        """
+        started = time.perf_counter()
+        count, adc = self.pi.spi_xfer(self.handle, _command(channel))
+        self._observe(1, time.perf_counter() - started)
+        return _value(adc)
+
+    def _observe(self, transfers, seconds):
+        histogram = self._spi_seconds.get(transfers)
+        if histogram is None:
+            histogram = self._spi_seconds[transfers] = SPI_SECONDS.labels(transfers)
+        histogram.observe(seconds)
+
+    def read_channels(self, channels=ALL_CHANNELS, oversample=1, method=MEAN):
+        """
+        Reads several channels in one round-trip to pigpiod.
+        The MCP3008 needs its chip select toggled for every conversion, so
+        each reading is still its own SPI transfer, but all the transfer
+        commands are sent to pigpiod at once and the replies read back
+        together instead of waiting for each one.
+        channels (sequence): channels to read
+        oversample (int): readings taken per channel
+        method (str): MEAN or MEDIAN, how oversampled readings are combined
+        Returns a float NumPy array with one value per channel.
+        """
+        channels = tuple(channels)
+        sl = getattr(self.pi, "sl", None)
+        if sl is None:
+            # Not a socket connection to pigpiod, transfer one by one
+            raw = np.array([[self.read(channel) for channel in channels]
+                            for i in range(oversample)], dtype=np.float64)
+        else:
+            raw = self._read_pipelined(sl, channels, oversample)
+
+        if oversample == 1:
+            return raw[0]
+        if method == MEDIAN:
+            return np.median(raw, axis=0)
+        return raw.mean(axis=0)
+
+    def _request(self, channels, oversample):
+        key = (channels, oversample)
+        request = self._requests.get(key)
+        if request is None:
+            request = bytearray()
+            for i in range(oversample):
+                for channel in channels:
+                    request.extend(struct.pack('IIII', _PI_CMD_SPIX, self.handle, 0, 3))
+                    request.extend(_command(channel))
+            request = bytes(request)
+            self._requests[key] = request
+        return request
+
+    def _read_pipelined(self, sl, channels, oversample):
+        request = self._request(channels, oversample)
+        raw = np.zeros((oversample, len(channels)), dtype=np.float64)
+        error = 0
+        started = time.perf_counter()
+        with sl.l:
+            sl.s.sendall(request)
+            # Every command gets a reply, read them all even after an
+            # error so the socket stays in step
+            for i in range(oversample):
+                for j in range(len(channels)):
+                    cmd, p1, p2, res = struct.unpack('IIIi', self._recv(sl, _SOCK_CMD_LEN))
+                    if res > 0:
+                        raw[i, j] = _value(self._recv(sl, res))
+                    elif res < 0:
+                        error = res
+        self._observe(len(channels) * oversample, time.perf_counter() - started)
+        # each one a pigpiod command, as many as read() would have made
+        count_calls = getattr(self.pi, "count_calls", None)
+        if count_calls is not None:
+            count_calls(len(channels) * oversample)
+        if error:
+            raise pigpio.error(pigpio.error_text(error))
+        return raw
+
+    def _recv(self, sl, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = sl.s.recv(count - len(data))
+            if not chunk:
+                raise pigpio.error("pigpiod closed the connection")
+            data.extend(chunk)
+        return data
+
+    def close(self):
+        self.pi.spi_close(self.handle)
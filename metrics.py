@@ -0,0 +1,259 @@
+import bisect
+import os
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+METRICS_HOST = os.environ.get("GREENHOUSE_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("GREENHOUSE_METRICS_PORT", "9110"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+DURATION_BUCKETS = (0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(n, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for n, v in pairs]
+    return "{" + ",".join('{}="{}"'.format(n, v) for n, v in escaped) + "}"
+
+class Counter(object):
+    """
+    A count that only goes up.
+    """
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, labelvalues):
+        yield name + _format_labels(labelnames, labelvalues), self.value
+
+class Gauge(object):
+    """
+    A value that goes up and down, either set or read from function when
+    scraped.
+    """
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, labelvalues):
+        value = self.function() if self.function is not None else self.value
+        yield name + _format_labels(labelnames, labelvalues), value
+
+class Histogram(object):
+    """
+    Counts observations into buckets. Observing is a bisect and three
+    additions, cheap enough for every tick.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket, plus one for above the largest
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labelnames, labelvalues):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = ("le", _format_value(float(bound)))
+            yield name + "_bucket" + _format_labels(labelnames, labelvalues, le), cumulative
+        yield name + "_sum" + _format_labels(labelnames, labelvalues), total
+        yield name + "_count" + _format_labels(labelnames, labelvalues), count
+
+class Family(object):
+    def __init__(self, kind, cls, name, help, labelnames, **kwargs):
+        """
+        A metric and its children, one per set of label values.
+        """
+        self.kind = kind
+        self.cls = cls
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """
+        Returns the child for labelvalues, created on first use. Keep the
+        child rather than calling this on a hot path.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("{} takes labels {}".format(self.name, self.labelnames))
+        labelvalues = tuple(str(v) for v in labelvalues)
+        with self._lock:
+            child = self.children.get(labelvalues)
+            if child is None:
+                child = self.children[labelvalues] = self.cls(**self.kwargs)
+        return child
+
+    def expose(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.help.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {} {}".format(self.name, self.kind))
+        with self._lock:
+            children = sorted(self.children.items())
+        for labelvalues, child in children:
+            for sample, value in child.samples(self.name, self.labelnames, labelvalues):
+                lines.append("{} {}".format(sample, _format_value(value)))
+
+class Registry(object):
+    def __init__(self):
+        """
+        The metrics of the app, rendered in the Prometheus text format.
+        """
+        self.families = {}
+        self._lock = threading.Lock()
+
+    def _family(self, kind, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(kind, cls, name, help, labelnames, **kwargs)
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise ValueError("metric {} already registered differently".format(name))
+        # Without labels there is a single child, hand it out directly
+        return family.labels() if not family.labelnames else family
+
+    def counter(self, name, help, labelnames=()):
+        return self._family("counter", Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self._family("gauge", Gauge, name, help, labelnames, function=function)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._family("histogram", Histogram, name, help, labelnames, buckets=buckets)
+
+    def expose(self):
+        lines = []
+        with self._lock:
+            families = sorted(self.families.items())
+        for name, family in families:
+            family.expose(lines)
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.counter(name, help, labelnames)
+
+def gauge(name, help, labelnames=(), function=None):
+    return REGISTRY.gauge(name, help, labelnames, function)
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+PIGPIO_CALLS = counter("greenhouse_pigpio_calls_total", "Calls made through pigpio, all threads")
+
+class CountingPi(object):
+    def __init__(self, pi):
+        """
+        Wraps a pigpio connection, counting the calls made through it in
+        self.calls and greenhouse_pigpio_calls_total. Everything else is
+        passed through.
+        """
+        self._pi = pi
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._pi, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            PIGPIO_CALLS.inc()
+            return attribute(*args, **kwargs)
+        # Looked up once, the instance attribute is found directly after
+        setattr(self, name, call)
+        return call
+
+    def count_calls(self, calls):
+        """
+        Counts commands sent to pigpiod without a call through the
+        wrapper, such as those written to its socket in one go.
+        """
+        self.calls += calls
+        PIGPIO_CALLS.inc(calls)
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(object):
+    def __init__(self, registry=REGISTRY, host=METRICS_HOST, port=METRICS_PORT):
+        """
+        Serves the registry on http://host:port/metrics from its own thread.
+        Only rendered when scraped, so it costs nothing in between.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if self._server is not None:
+            return
+        self._server = HTTPServer((self.host, self.port), _Handler)
+        self._server.registry = self.registry
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
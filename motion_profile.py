@@ -0,0 +1,152 @@
+import collections
+import hashlib
+import os
+import zipfile
+import numpy as np
+
+TRAPEZOIDAL = "trapezoidal"
+S_CURVE = "s-curve"
+
+CACHE_DIR = os.environ.get(
+    "GREENHOUSE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "greenhouse"))
+# Part of the cache keys, changed whenever the profiles computed change so
+# profiles cached before are not used
+CACHE_VERSION = 2
+
+# accel: step periods in µs of the acceleration ramp (numpy uint32 array),
+# deceleration is the same ramp reversed.
+# const_delay: step period in µs at cruise speed
+# const_steps: number of steps at cruise speed
+Profile = collections.namedtuple('Profile', ['accel', 'const_delay', 'const_steps'])
+
+_cache = {}
+
+def _periods(step_times_s):
+    """
+    Step periods in µs from the times at which each step is made.
+    """
+    periods = np.diff(step_times_s, prepend=0.0) * 1000000
+    return np.maximum(np.rint(periods), 2).astype(np.uint32)
+
+def _finish(step_times_s, num_steps, steps_per_m, max_velocity_ms, cut_short):
+    accel = _periods(step_times_s)
+    const_delay = int(round(1000000 / (steps_per_m * max_velocity_ms)))
+    # Never cruise faster than the end of a ramp cut short by a short move.
+    # A full ramp ends at cruise speed, but its last period is the time
+    # since the step before, on a ramp of a step or two the one from rest
+    if cut_short and len(accel):
+        const_delay = max(const_delay, int(accel[-1]))
+    const_steps = int(num_steps) - 2 * len(accel)
+    return Profile(accel, const_delay, const_steps)
+
+def _trapezoidal(num_steps, steps_per_m, acceleration_ms2, max_velocity_ms):
+    # Constant acceleration from rest, step n is made when a t^2 / 2 = n / S
+    full_ramp_steps = int(max_velocity_ms ** 2 / (2 * acceleration_ms2) * steps_per_m)
+    ramp_steps = min(full_ramp_steps, int(num_steps) // 2)
+    n = np.arange(1, ramp_steps + 1, dtype=np.float64)
+    step_times_s = np.sqrt(2 * n / (steps_per_m * acceleration_ms2))
+    return _finish(step_times_s, num_steps, steps_per_m, max_velocity_ms,
+                   ramp_steps < full_ramp_steps)
+
+def _s_curve(num_steps, steps_per_m, acceleration_ms2, max_velocity_ms, jerk_ms3):
+    # Jerk limited ramp: acceleration rises with jerk_ms3, holds, then falls
+    # back to zero as the cruise speed is reached
+    accel = min(acceleration_ms2, np.sqrt(max_velocity_ms * jerk_ms3))
+    t_jerk = accel / jerk_ms3
+    t_const = max_velocity_ms / accel - t_jerk
+    t1 = t_jerk
+    t2 = t_jerk + t_const
+    t_end = t2 + t_jerk
+    v1 = jerk_ms3 * t1 ** 2 / 2
+    x1 = jerk_ms3 * t1 ** 3 / 6
+    v2 = v1 + accel * t_const
+    x2 = x1 + v1 * t_const + accel * t_const ** 2 / 2
+
+    def position(t):
+        tau2 = t - t1
+        tau3 = t - t2
+        return np.where(t < t1, jerk_ms3 * t ** 3 / 6, np.where(
+            t < t2, x1 + v1 * tau2 + accel * tau2 ** 2 / 2,
+            x2 + v2 * tau3 + accel * tau3 ** 2 / 2 - jerk_ms3 * tau3 ** 3 / 6))
+
+    def velocity(t):
+        tau2 = t - t1
+        tau3 = t - t2
+        return np.where(t < t1, jerk_ms3 * t ** 2 / 2, np.where(
+            t < t2, v1 + accel * tau2,
+            v2 + accel * tau3 - jerk_ms3 * tau3 ** 2 / 2))
+
+    full_ramp_steps = int(position(np.float64(t_end)) * steps_per_m)
+    ramp_steps = min(full_ramp_steps, int(num_steps) // 2)
+    targets = np.arange(1, ramp_steps + 1, dtype=np.float64) / steps_per_m
+
+    # Invert position(t): interpolate on a grid, then polish with Newton
+    grid = np.linspace(0.0, t_end, max(4 * ramp_steps, 1000))
+    step_times_s = np.interp(targets, position(grid), grid)
+    for i in range(4):
+        v = np.maximum(velocity(step_times_s), 1e-9)
+        step_times_s = np.clip(step_times_s - (position(step_times_s) - targets) / v, 0.0, t_end)
+    return _finish(step_times_s, num_steps, steps_per_m, max_velocity_ms,
+                   ramp_steps < full_ramp_steps)
+
+def _cache_path(key):
+    digest = hashlib.sha1(repr((CACHE_VERSION,) + key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "profile-{}.npz".format(digest))
+
+def _load(path):
+    # A missing, truncated or corrupt file is computed again and
+    # overwritten by _save()
+    try:
+        with np.load(path) as data:
+            return Profile(data["accel"], int(data["const_delay"]), int(data["const_steps"]))
+    except (IOError, OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+
+def _save(path, result):
+    # Written to a file of its own and renamed over path, so a reader
+    # never sees half a file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, accel=result.accel, const_delay=result.const_delay,
+                     const_steps=result.const_steps)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        # The cache is only an optimisation
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def profile(num_steps, steps_per_m, acceleration_ms2, max_velocity_ms,
+            kind=TRAPEZOIDAL, jerk_ms3=None):
+    """
+    Step timing of a move of num_steps steps, see Profile.
+    Results are memoized in memory and in CACHE_DIR, keyed by the
+    parameters, so repeated moves and restarts cost nothing.
+    kind (str): TRAPEZOIDAL or S_CURVE
+    jerk_ms3 (float): jerk limit, required for S_CURVE
+    """
+    if kind == S_CURVE and not jerk_ms3:
+        raise ValueError("an s-curve profile needs jerk_ms3")
+    key = (kind, int(num_steps), float(steps_per_m), float(acceleration_ms2),
+           float(max_velocity_ms), float(jerk_ms3) if kind == S_CURVE else None)
+    result = _cache.get(key)
+    if result is not None:
+        return result
+
+    path = _cache_path(key)
+    result = _load(path)
+    if result is None:
+        if kind == TRAPEZOIDAL:
+            result = _trapezoidal(*key[1:5])
+        elif kind == S_CURVE:
+            result = _s_curve(*key[1:6])
+        else:
+            raise ValueError("unknown motion profile {}".format(kind))
+        _save(path, result)
+    _cache[key] = result
+    return result
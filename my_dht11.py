@@ -2,126 +2,293 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import, division, print_function, unicode_literals
+import array
+import collections
+import threading
 import time
+import numpy as np
 import pigpio
+import backend
+import clock
+import events
+import metrics
+from sensor_cache import SensorCache
+
+# A frame is about 84 edges, leave room for glitches
+MAX_EDGES = 128
+# High pulses at least this long (µs) are 1 bits
+BIT_THRESHOLD_US = 50
+# The DHT11 must not be triggered more often than this
+MIN_INTERVAL_S = 1.0
+
+# decode_edges() status codes
+OK = 0
+NO_DATA = 1
+BAD_CHECKSUM = 2
+
+READS = metrics.counter("greenhouse_dht11_reads_total", "DHT11 reads by result",
+                        ("gpio", "result"))
+
+# A validated reading published by the background acquisition worker
+Sample = collections.namedtuple('Sample', ['temperature', 'humidity', 'timestamp'])
+
+def decode_edges(ticks, levels, count, frame):
+    """
+    Decode the last 40 data bits of an edge buffer into frame.
+    Works in place on the buffers, nothing is allocated per edge.
+    ticks (sequence): tick of each edge in µs, as passed to the callback
+    levels (sequence): level after each edge
+    count (int): number of valid edges in ticks and levels
+    frame (bytearray): 5 byte output, integral and decimal humidity,
+        integral and decimal temperature, checksum
+    Returns OK, NO_DATA or BAD_CHECKSUM.
+    """
+    if count < 10:
+        return NO_DATA
+
+    frame[0] = frame[1] = frame[2] = frame[3] = frame[4] = 0
+
+    # Walk backwards so the last 40 bits land straight in their byte
+    bit = 0
+    idx = count - 2
+    while idx >= 0 and bit < 40:
+        if levels[idx] != 0:
+            # Ticks are 32 bit and wrap around
+            duration = (ticks[idx + 1] - ticks[idx]) & 0xffffffff
+            if duration >= BIT_THRESHOLD_US:
+                frame[4 - (bit >> 3)] |= 1 << (bit & 7)
+            bit += 1
+        idx -= 1
+
+    if bit < 40:
+        return NO_DATA
+    if frame[4] != (frame[0] + frame[1] + frame[2] + frame[3]) & 0xff:
+        return BAD_CHECKSUM
+    return OK
+
+def frame_values(frame):
+    """
+    Returns (humidity, temperature) of a decoded frame, including the
+    decimal parts. Bit 7 of the decimal temperature byte is the sign.
+    """
+    humidity = frame[0] + frame[1] * 0.1
+    temperature = frame[2] + (frame[3] & 0x7f) * 0.1
+    if frame[3] & 0x80:
+        temperature = -temperature
+    return humidity, temperature
+
+def decode_frames(ticks, levels, counts=None):
+    """
+    Decode many captured frames at once with NumPy.
+    ticks (array): (frames, edges) edge ticks in µs, one frame per row
+    levels (array): (frames, edges) level after each edge
+    counts (array): number of valid edges per row, defaults to all
+    Returns (humidity, temperature, status) arrays, status holds
+    OK, NO_DATA or BAD_CHECKSUM per frame.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    levels = np.asarray(levels)
+    num_frames, num_edges = ticks.shape
+    if counts is None:
+        counts = np.full(num_frames, num_edges)
+    counts = np.asarray(counts)
+
+    durations = (ticks[:, 1:] - ticks[:, :-1]) & 0xffffffff
+    valid = np.arange(num_edges - 1) < (counts[:, None] - 1)
+    is_bit = (levels[:, :-1] != 0) & valid
+    ones = is_bit & (durations >= BIT_THRESHOLD_US)
+
+    # Position of each bit counted from the end of the frame, 0 is the
+    # least significant bit of the checksum
+    from_end = np.cumsum(is_bit[:, ::-1], axis=1)[:, ::-1] - 1
+    keep = is_bit & (from_end < 40)
+    weights = np.where(keep & ones, 1 << (from_end & 7), 0)
+    byte_idx = 4 - (from_end >> 3)
+
+    frames = np.empty((num_frames, 5), dtype=np.int64)
+    for b in range(5):
+        frames[:, b] = np.where(byte_idx == b, weights, 0).sum(axis=1)
+
+    status = np.full(num_frames, OK, dtype=np.uint8)
+    status[(frames[:, :4].sum(axis=1) & 0xff) != frames[:, 4]] = BAD_CHECKSUM
+    status[(counts < 10) | (is_bit.sum(axis=1) < 40)] = NO_DATA
+
+    humidity = frames[:, 0] + frames[:, 1] * 0.1
+    temperature = frames[:, 2] + (frames[:, 3] & 0x7f) * 0.1
+    temperature = np.where(frames[:, 3] & 0x80, -temperature, temperature)
+    return humidity, temperature, status
 
 class DHT11(object):
-    def __init__(self, pi, gpio):
+    def __init__(self, pi, gpio, capture=None, host=None):
         """
         pi (pigpio): an instance of pigpio
         gpio (int): gpio pin number
+        capture (notify.EdgeCapture): get the edges of a frame in bulk
+            from it, rather than from a callback per edge
+        host (str): the greenhouse the sensor is in, for its events when
+            one process reads many
         """
         self.pi = pi
         self.gpio = gpio
+        self.host = host
+        self.capture = capture
+        self.clock = clock.of(pi)
         self.temperature = 0
         self.humidity = 0
         self.either_edge_cb = None
-        self.data = []
+        # Edge buffer filled by the callback, preallocated so a read
+        # does not allocate per edge
+        self.ticks = array.array('L', [0] * MAX_EDGES)
+        self.levels = bytearray(MAX_EDGES)
+        self.num_edges = 0
+        self.frame = bytearray(5)
+        self.sample = None
+        # every reading with its capture time and validity, retried after
+        # failures no faster than the sensor allows
+        self.cache = SensorCache("dht11_{}".format(gpio), self._acquire_sample,
+                                 ttl=MIN_INTERVAL_S, min_interval=MIN_INTERVAL_S,
+                                 retry_min_s=MIN_INTERVAL_S, clock=self.clock)
+        self._worker = None
+        self._stop_event = threading.Event()
+        self._reads = {
+            OK: READS.labels(gpio, "ok"),
+            NO_DATA: READS.labels(gpio, "no_data"),
+            BAD_CHECKSUM: READS.labels(gpio, "bad_checksum"),
+        }
         
         # Clears the internal gpio pull-up/down resistor
         self.pi.set_pull_up_down(self.gpio, pigpio.PUD_OFF)
 
-        # Monitors EDGE changes using callback.
-        self.either_edge_cb = self.pi.callback(
-            self.gpio,
-            pigpio.EITHER_EDGE,
-            self.either_edge_callback
-        )
+        if self.capture is not None:
+            self.capture.add(self.gpio)
+        else:
+            # Monitors EDGE changes using callback.
+            self.either_edge_cb = self.pi.callback(
+                self.gpio,
+                pigpio.EITHER_EDGE,
+                self.either_edge_callback
+            )
 
     def either_edge_callback(self, gpio, level, tick):
         """
         Either Edge callbacks, called each time the gpio edge changes.
         Accumulate the 40 data bits from the dht11 sensor.
         """
-        self.data.append((tick, level))
+        n = self.num_edges
+        if n < MAX_EDGES:
+            self.ticks[n] = tick
+            self.levels[n] = level
+            self.num_edges = n + 1
 
     def read(self):
         """
         Start reading over DHT11 sensor.
         """
-        self.data = []
-        data_bits = []
-        
-        integ_rh_data = ''
-        dec_rh_data = ''
-        integ_t_data = ''
-        dec_t_data = ''
-        checksum_data = ''
-        
+        self.num_edges = 0
+        if self.capture is not None:
+            self.capture.arm(self.gpio)
+
         self.pi.write(self.gpio, pigpio.LOW)
-        time.sleep(0.017) # 17 ms
+        self.clock.sleep(0.017) # 17 ms
         self.pi.set_mode(self.gpio, pigpio.INPUT)
         #self.pi.set_watchdog(self.gpio, 200)
-        time.sleep(0.2)
+        self.clock.sleep(0.2)
 
-        if len(self.data) < 10:
-            print("ERROR: NO DATA REVEIVED")
+        if self.capture is not None:
+            status, humidity, temperature = self._decode_captured()
+        else:
+            status = decode_edges(self.ticks, self.levels, self.num_edges, self.frame)
+            if status == OK:
+                humidity, temperature = frame_values(self.frame)
+        self._reads[status].inc()
+        if status == NO_DATA:
+            events.error("dht11.no_data", rate_key=(self.host, self.gpio), host=self.host, gpio=self.gpio)
+            return False
+        if status == BAD_CHECKSUM:
+            events.error("dht11.bad_checksum", rate_key=(self.host, self.gpio), host=self.host,
+                         gpio=self.gpio)
             return False
-        
-        for idx in range(len(self.data) - 1):
-            tick = self.data[idx][0]-self.data[0][0]
-            level = self.data[idx][1]
-            duration = self.data[idx+1][0]-self.data[idx][0]
-            if level == 0:
-                type = "sync"
-            elif duration < 50:
-                type = "Bit 0"
-                data_bits.append('0')
-            elif duration >= 50:
-                type = "Bit 1"
-                data_bits.append('1')
-
-            # print("Tick: {}, Level: {}, Duration: {}, Type: {}".format(tick, level, duration, type))
 
+        self.humidity, self.temperature = humidity, temperature
 
-        for idx in range(len(data_bits)-8, len(data_bits)):
-            checksum_data += data_bits[idx]
+        # Rebinding a single attribute is atomic, so consumers on other
+        # threads always see a consistent (temperature, humidity) pair.
+        self.sample = Sample(self.temperature, self.humidity, self.clock.time())
 
-        for idx in range(len(data_bits)-16, len(data_bits)-8):
-            dec_t_data += data_bits[idx]
+        return True
 
-        for idx in range(len(data_bits)-24, len(data_bits)-16):
-            integ_t_data += data_bits[idx]
+    def _decode_captured(self):
+        # Returns (status, humidity, temperature), the whole frame decoded
+        # at once from the edges captured in bulk
+        ticks, levels = self.capture.collect(self.gpio)
+        if len(ticks) < 10:
+            return NO_DATA, None, None
+        humidity, temperature, status = decode_frames(ticks[None, -MAX_EDGES:],
+                                                      levels[None, -MAX_EDGES:])
+        return status[0], float(humidity[0]), float(temperature[0])
 
-        for idx in range(len(data_bits)-32, len(data_bits)-24):
-            dec_rh_data += data_bits[idx]
+    def _acquire_sample(self):
+        return self.sample if self.read() else None
 
-        for idx in range(len(data_bits)-40, len(data_bits)-32):
-            integ_rh_data += data_bits[idx]
+    def reading(self, now=None):
+        """
+        Returns the latest sensor_cache.Reading, its value a Sample, without
+        blocking. The last good Sample is kept after failed reads, marked
+        not valid, and stale once too old to trust.
+        """
+        return self.cache.peek(now)
 
-        checksum = int(checksum_data, 2)
-        dec_temp = int(dec_t_data, 2)
-        integ_temp = int(integ_t_data, 2)
-        dec_humid = int(dec_rh_data, 2)
-        integ_humid = int (integ_rh_data, 2)
+    def start(self, interval=1.0):
+        """
+        Start background acquisition.
+        A worker thread reads the sensor every interval seconds and publishes
+        the latest valid reading in self.sample and reading(), so consumers
+        never block on the sensor. A failed read is retried sooner, after
+        MIN_INTERVAL_S at first. read() must not be called directly while
+        this is running.
+        interval (float): seconds between reads, the DHT11 needs at least 1 s
+        """
+        if self._worker is not None:
+            return
+        self.cache.ttl = max(interval, MIN_INTERVAL_S)
+        self.cache.max_age = 3 * self.cache.ttl
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._acquire)
+        self._worker.daemon = True
+        self._worker.start()
 
-        if checksum != (dec_temp + integ_temp + dec_humid + integ_humid) & 0xff:
-            print("ERROR: WRONG CHECKSUM")
-            return False
-        
-        # print(data_bits)
-        # print("Integral Humidity: {} ({})".format(integ_rh_data, int(integ_rh_data, 2)))
-        # print("Decimal Humidity: {} ({})".format(dec_rh_data, int(dec_rh_data, 2)))
-        # print("Integral Temperature: {} ({})".format(integ_t_data, int(integ_t_data, 2)))
-        # print("Decimal Temperature: {} ({})".format(dec_t_data, int(dec_t_data, 2)))
-        # print("Checksum: {} ({})".format(checksum, int(checksum, 2)))
+    def stop(self):
+        """
+        Stop background acquisition and wait for the worker to finish.
+        """
+        if self._worker is None:
+            return
+        self._stop_event.set()
+        self._worker.join()
+        self._worker = None
 
-        self.temperature = integ_temp
-        self.humidity = integ_humid
+    def _acquire(self):
+        while not self._stop_event.is_set():
+            # the cache schedules the next read, the interval after a good
+            # one or the retry delay after a failure, never sooner than
+            # MIN_INTERVAL_S after the last
+            self.cache.get()
+            self.clock.wait(self._stop_event, self.cache.next_attempt - self.clock.time())
 
-        return True
-            
     def close(self):
         """
         Stop reading sensor, remove callbacks.
         """
+        self.stop()
         self.pi.set_watchdog(self.gpio, 0)
+        if self.capture is not None:
+            self.capture.remove(self.gpio)
         if self.either_edge_cb:
             self.either_edge_cb.cancel()
             self.either_edge_cb = None
 
 if __name__ == '__main__':
-    pi = pigpio.pi()
+    pi = backend.connect()
     sensor1 = DHT11(pi, 16)
     sensor2 = DHT11(pi, 17)
 
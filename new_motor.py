@@ -1,8 +1,11 @@
 import pigpio
+import backend
 from time import sleep
 import math
+import motion_profile
+import waves
 
-pi = pigpio.pi()
+pi = backend.connect()
 PIN_STEP = 21
 PIN_ENN = 4
 PIN_DIR = 20
@@ -18,35 +21,11 @@ STEPS_PER_M = STEPS_PER_REV / PULLEY_CIRCUMF_M
 TOTAL_STEPS = HEIGHT_M * STEPS_PER_M
 print("total steps: {}".format(TOTAL_STEPS))
 
-accel_sequence = []
-decel_sequence = []
-const_sequence = []
+profile = motion_profile.profile(TOTAL_STEPS, STEPS_PER_M, ACCELERATION_MS2, MAX_VELOCITY_MS)
+print("accel/decel steps: {}".format(len(profile.accel)))
 
-current_velocity_ms = 0.0
-current_steps = 0.0
-current_height_m = 0.0
-time_since_start_s = 0.001
-
-while current_velocity_ms < MAX_VELOCITY_MS and current_steps < TOTAL_STEPS/2:
-    current_velocity_ms = ACCELERATION_MS2 * time_since_start_s
-    delta_t_s = (1 / STEPS_PER_M) / current_velocity_ms
-    #                              	 ON   	 OFF         DELAY
-    accel_sequence.append(pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-    accel_sequence.append(pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-
-    decel_sequence.insert(0, pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-    decel_sequence.insert(0, pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-
-    current_steps += 1
-    time_since_start_s += delta_t_s
-print("accel/decel steps: {}".format(current_steps))
-
-delta_t_s = (1 / STEPS_PER_M) / MAX_VELOCITY_MS
-const_sequence.append(pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-const_sequence.append(pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-num_steps_const_sequence = int(TOTAL_STEPS - (current_steps * 2))
-if num_steps_const_sequence >= 0xffff:
-    print("burp")
+# split the move into waves and loops that fit pigpio's limits
+segments, accel = waves.plan(profile)
 
 pi.set_mode(PIN_STEP, pigpio.OUTPUT)
 pi.set_mode(PIN_ENN, pigpio.OUTPUT)
@@ -61,24 +40,8 @@ pi.write(PIN_ENN, 0)
 #	pi.write(20, 0)
 #	sleep(0.0001)
 
-pi.wave_clear()
-
-pi.wave_add_generic(accel_sequence)
-wid_accel = pi.wave_create()
-
-pi.wave_add_generic(decel_sequence)
-wid_decel = pi.wave_create()
-
-pi.wave_add_generic(const_sequence)
-wid_const = pi.wave_create()
-
-pi.wave_chain([
-    wid_accel,
-    255, 0,
-    wid_const,
-    255, 1, num_steps_const_sequence & 0xff, num_steps_const_sequence >> 8,
-    wid_decel,
-])
+wave_cache = waves.WaveCache(pi, PIN_STEP)
+pi.wave_chain(wave_cache.chain(segments))
 
 while pi.wave_tx_busy():
     sleep(0.1);
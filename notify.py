@@ -0,0 +1,146 @@
+import socket
+import struct
+import threading
+import numpy as np
+import pigpio
+
+# pigpio socket command opening a notification handle on the socket it
+# is sent on, as the pigpio module does for its callbacks
+_PI_CMD_NOIB = 99
+_SOCK_CMD_LEN = 16
+
+# The reports pigpiod sends for every level change of the gpios watched
+REPORT_DTYPE = np.dtype([
+    ('seq', '<u2'),
+    ('flags', '<u2'),
+    ('tick', '<u4'),
+    ('level', '<u4'),
+])
+REPORT_SIZE = REPORT_DTYPE.itemsize
+
+RECV_SIZE = 65536
+
+def _recv(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise pigpio.error("notification socket closed")
+        data.extend(chunk)
+    return data
+
+def open_notify_socket(pi):
+    """
+    Returns (handle, socket) of a new notification stream from pigpiod.
+    Backends other than pigpio provide their own notify_socket().
+    """
+    opener = getattr(pi, "notify_socket", None)
+    if opener is not None:
+        return opener()
+    sock = socket.create_connection((pi._host, int(pi._port)))
+    sock.sendall(struct.pack('IIII', _PI_CMD_NOIB, 0, 0, 0))
+    cmd, p1, p2, res = struct.unpack('IIIi', _recv(sock, _SOCK_CMD_LEN))
+    if res < 0:
+        sock.close()
+        raise pigpio.error(pigpio.error_text(res))
+    return res, sock
+
+class EdgeCapture(object):
+    def __init__(self, pi):
+        """
+        Captures the edges of several gpios in bulk on a notification
+        stream of its own, instead of one Python callback per edge.
+        The reports are only buffered as bytes while a capture is armed,
+        and turned into edges all at once when it is collected.
+        pi (pigpio): an instance of pigpio
+        """
+        self.pi = pi
+        self.bits = 0
+        self.handle, self.sock = open_notify_socket(pi)
+
+        self._lock = threading.Lock()
+        self._data = bytearray()
+        # stream position of self._data[0], and the levels before it
+        self._base = 0
+        self._base_level = pi.read_bank_1()
+        self._armed = {}
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def add(self, gpio):
+        self.bits |= 1 << gpio
+        self.pi.notify_begin(self.handle, self.bits)
+
+    def remove(self, gpio):
+        self.bits &= ~(1 << gpio)
+        with self._lock:
+            self._armed.pop(gpio, None)
+        self.pi.notify_begin(self.handle, self.bits)
+
+    def _read_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                return
+            with self._lock:
+                if self._armed:
+                    self._data.extend(data)
+                else:
+                    # nobody is listening, keep only a partial report
+                    self._advance(self._base + len(self._data) + len(data), self._data + data)
+
+    def _advance(self, position, data):
+        # drops the data before stream position, a whole report boundary,
+        # keeping the levels of the last report dropped
+        keep = position - self._base
+        keep -= keep % REPORT_SIZE
+        if keep >= REPORT_SIZE:
+            last = data[keep - REPORT_SIZE:keep]
+            self._base_level = struct.unpack('<HHII', bytes(last))[3]
+        self._data = bytearray(data[keep:])
+        self._base += keep
+
+    def arm(self, gpio):
+        """
+        Starts capturing the edges of gpio from now on.
+        """
+        with self._lock:
+            position = self._base + len(self._data)
+            self._armed[gpio] = position - (position - self._base) % REPORT_SIZE
+
+    def collect(self, gpio):
+        """
+        Stops capturing gpio and returns the (ticks, levels) NumPy arrays
+        of its edges since arm().
+        """
+        with self._lock:
+            start = self._armed.pop(gpio) - self._base
+            end = len(self._data) - len(self._data) % REPORT_SIZE
+            if start >= REPORT_SIZE:
+                level = struct.unpack('<HHII', bytes(self._data[start - REPORT_SIZE:start]))[3]
+            else:
+                level = self._base_level
+            reports = np.frombuffer(bytes(self._data[start:end]), dtype=REPORT_DTYPE)
+            position = min(self._armed.values()) if self._armed else self._base + end
+            self._advance(position, self._data)
+
+        reports = reports[reports['flags'] == 0]
+        bits = (reports['level'] >> gpio) & 1
+        changed = np.flatnonzero(np.diff(bits, prepend=(level >> gpio) & 1))
+        return reports['tick'][changed].astype(np.int64), bits[changed].astype(np.uint8)
+
+    def close(self):
+        try:
+            self.pi.notify_close(self.handle)
+        except pigpio.error:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self.sock.close()
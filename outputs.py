@@ -0,0 +1,72 @@
+import threading
+import metrics
+
+BANK_WRITES = metrics.counter("greenhouse_output_bank_writes_total",
+                              "set_bank_1 and clear_bank_1 calls made for the outputs")
+
+class OutputBank(object):
+    def __init__(self, pi):
+        """
+        The output gpios 0-31, written in batches. Levels are staged with
+        set() and applied by flush() with at most one set_bank_1 and one
+        clear_bank_1, so outputs changed together switch together and
+        cost one round-trip to pigpiod each way. Levels already there are
+        not written again, the shadow register knows them without I/O.
+        pi (pigpio): an instance of pigpio
+        """
+        self.pi = pi
+        # levels last written, valid for the bits in self.known
+        self.shadow = 0
+        self.known = 0
+        self._high = 0
+        self._low = 0
+        self._lock = threading.Lock()
+
+    def set(self, gpio, level):
+        """
+        Stages gpio to be driven to level by the next flush().
+        """
+        bit = 1 << gpio
+        with self._lock:
+            if level:
+                self._high |= bit
+                self._low &= ~bit
+            else:
+                self._low |= bit
+                self._high &= ~bit
+
+    def write(self, gpio, level):
+        self.set(gpio, level)
+        self.flush()
+
+    def level(self, gpio):
+        """
+        Level gpio was last driven to, None if it never was.
+        """
+        bit = 1 << gpio
+        if not self.known & bit:
+            return None
+        return int(bool(self.shadow & bit))
+
+    def flush(self):
+        """
+        Writes the staged levels that differ from the shadow register.
+        Returns True if anything was written. A write that raises leaves
+        its levels staged, and the shadow as it was, for the next flush().
+        """
+        with self._lock:
+            high = self._high & ~(self.shadow & self.known)
+            low = self._low & ~(~self.shadow & self.known)
+            if high:
+                self.pi.set_bank_1(high)
+                BANK_WRITES.inc()
+                self.shadow |= high
+                self.known |= high
+            self._high = 0
+            if low:
+                self.pi.clear_bank_1(low)
+                BANK_WRITES.inc()
+                self.shadow &= ~low
+                self.known |= low
+            self._low = 0
+        return bool(high or low)
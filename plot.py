@@ -0,0 +1,155 @@
+import time
+import numpy as np
+from matplotlib.backends.backend_gtk3agg import (
+        FigureCanvasGTK3Agg as FigureCanvas)
+from matplotlib.figure import Figure
+import history
+
+# Redraw at most this often, and back off further when a redraw takes
+# more than FRAME_BUDGET of the frame
+MAX_FPS = 5.0
+FRAME_BUDGET = 0.5
+
+# Initial y ranges, widened (with a full redraw) when data leaves them
+MOISTURE_RANGE = (0, 1023)
+TEMPERATURE_RANGE = (0, 40)
+HUMIDITY_RANGE = (0, 100)
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of the points (x, y) to
+    threshold points, keeping the visual shape of the line.
+    Returns the indices of the points kept.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / float(threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+    # Average of each bucket from prefix sums, the third point of the
+    # triangles of the previous bucket
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    starts = edges[1:]
+    ends = np.append(edges[2:], n)
+    counts = ends - starts
+    avg_x = (cum_x[ends] - cum_x[starts]) / counts
+    avg_y = (cum_y[ends] - cum_y[starts]) / counts
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = edges[i]
+        end = edges[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        area = np.abs((x[a] - avg_x[i]) * (by - y[a]) - (x[a] - bx) * (avg_y[i] - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+class HistoryPlot(object):
+    def __init__(self, history_store, window_s=3600.0, max_fps=MAX_FPS):
+        """
+        Live plot of moisture, temperature and humidity history.
+        Time is plotted in seconds before now, so the axes stay put and
+        only the lines are redrawn (blitted) on each update. Long histories
+        are decimated to the pixel width of the plot.
+        history_store (history.History): where readings come from
+        window_s (float): how far back to show
+        max_fps (float): most redraws per second
+        """
+        self.history = history_store
+        self.window_s = window_s
+        self.min_interval = 1.0 / max_fps
+        self.last_draw = 0.0
+        self.draw_duration = 0.0
+
+        self.figure = Figure(figsize=(5, 4), dpi=100)
+        self.moisture_axes = self.figure.add_subplot(3, 1, 1)
+        self.temperature_axes = self.figure.add_subplot(3, 1, 2, sharex=self.moisture_axes)
+        self.humidity_axes = self.figure.add_subplot(3, 1, 3, sharex=self.moisture_axes)
+        self.moisture_axes.set_title("Automated Indoor Greenhouse")
+        self.moisture_axes.set_ylabel("Moisture")
+        self.temperature_axes.set_ylabel("°C")
+        self.humidity_axes.set_ylabel("%")
+        self.humidity_axes.set_xlabel("seconds ago")
+
+        self.axes = [self.moisture_axes, self.temperature_axes, self.humidity_axes]
+        for ax, y_range in zip(self.axes, [MOISTURE_RANGE, TEMPERATURE_RANGE, HUMIDITY_RANGE]):
+            ax.set_xlim(-self.window_s, 0)
+            ax.set_ylim(*y_range)
+
+        # (axes, history column, line)
+        self.lines = []
+        for i in range(8):
+            self._add_line(self.moisture_axes, i, "Plant {} {}".format(i // 2, "top" if i % 2 == 0 else "bottom"))
+        self._add_line(self.temperature_axes, history.INSIDE_TEMPERATURE, "inside")
+        self._add_line(self.temperature_axes, history.OUTSIDE_TEMPERATURE, "outside")
+        self._add_line(self.humidity_axes, history.INSIDE_HUMIDITY, "inside")
+        self._add_line(self.humidity_axes, history.OUTSIDE_HUMIDITY, "outside")
+
+        self.canvas = FigureCanvas(self.figure)
+        self.backgrounds = None
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def _add_line(self, ax, column, label):
+        line, = ax.plot([], [], label=label, animated=True)
+        self.lines.append((ax, column, line))
+
+    def on_draw(self, event):
+        # A full redraw happened (resize, new limits), grab the empty axes
+        self.backgrounds = [self.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+        for ax, column, line in self.lines:
+            ax.draw_artist(line)
+
+    def update(self):
+        """
+        Redraws the lines if the frame budget allows, call it as often as
+        wanted, e.g. from a GLib timeout. Returns True to keep the timeout.
+        """
+        now = time.time()
+        interval = max(self.min_interval, self.draw_duration / FRAME_BUDGET)
+        if now - self.last_draw < interval or self.backgrounds is None:
+            return True
+        self.last_draw = now
+
+        # simulated hardware may run ahead of the wall clock
+        latest = self.history.latest_time()
+        end = max(now, latest) if latest is not None else now
+        tier, times, values = self.history.query(self.window_s, end)
+        if tier != "raw":
+            # plot the means of downsampled tiers
+            values = values[:, 1, :]
+        x = times - end
+        width = int(self.moisture_axes.bbox.width)
+
+        rescale = False
+        for ax, column, line in self.lines:
+            y = values[:, column]
+            valid = ~np.isnan(y)
+            lx, ly = x[valid], y[valid]
+            kept = lttb(lx, ly, width)
+            line.set_data(lx[kept], ly[kept])
+            if len(ly):
+                low, high = ax.get_ylim()
+                if ly.min() < low or ly.max() > high:
+                    ax.set_ylim(min(low, ly.min()), max(high, ly.max()))
+                    rescale = True
+
+        if rescale:
+            # new limits, redraw everything, on_draw() draws the lines
+            self.canvas.draw()
+        else:
+            for ax, background in zip(self.axes, self.backgrounds):
+                self.canvas.restore_region(background)
+            for ax, column, line in self.lines:
+                ax.draw_artist(line)
+            for ax in self.axes:
+                self.canvas.blit(ax.bbox)
+        self.draw_duration = time.time() - now
+        return True
@@ -0,0 +1,508 @@
+"""
+Recording and replay of the raw hardware traffic of a greenhouse.
+
+Record a field unit with
+
+    GREENHOUSE_RECORD=field.rec python greenhouse.py
+
+and replay it without a Pi, here 10 times faster than it was recorded,
+
+    python recording.py field.rec --speed 10
+
+or run the daemon and user interface on it with GREENHOUSE_BACKEND=replay
+GREENHOUSE_REPLAY=field.rec.
+
+A recording is a header followed by records of
+    time (float64 s since the start), kind (uint8), size (uint16), payload
+holding DHT11 and lightgate edges, pigpio notification reports, MCP3008
+SPI frames, the output and wave commands sent and the user's actions,
+e.g. mode changes, which the replay repeats.
+"""
+import bisect
+import collections
+import json
+import socket
+import struct
+import sys
+import threading
+import numpy as np
+import pigpio
+import clock
+import events
+import sim_pigpio
+
+MAGIC = b"GHREC1\n"
+
+# Record kinds and their payloads
+EDGE = 1         # '<BBI' gpio, level, tick, from a callback
+NOTIFY = 2       # pigpio notification reports as received
+SPI_OPEN = 3     # '<Bi' spi channel, handle
+SPI = 4          # '<iB' handle, transmit size, then the bytes sent and received
+READ = 5         # '<BB' gpio, level
+READ_BANK = 6    # '<I' levels of gpios 0-31
+MODE = 7         # '<BB' gpio, mode
+WRITE = 8        # '<BB' gpio, level
+BANK_SET = 9     # '<I' bits
+BANK_CLEAR = 10  # '<I' bits
+WAVE_CHAIN = 11  # the chain bytes
+WAVE_TX_STOP = 12
+ACTION = 13      # JSON {"action": name, ...arguments}, see Greenhouse
+
+COMMANDS = (WRITE, BANK_SET, BANK_CLEAR, WAVE_CHAIN, WAVE_TX_STOP)
+KIND_NAMES = {EDGE: "edge", NOTIFY: "notify", SPI_OPEN: "spi_open", SPI: "spi", READ: "read",
+              READ_BANK: "read_bank", MODE: "mode", WRITE: "write", BANK_SET: "bank_set",
+              BANK_CLEAR: "bank_clear", WAVE_CHAIN: "wave_chain", WAVE_TX_STOP: "wave_tx_stop",
+              ACTION: "action"}
+
+_HEADER = struct.Struct('<dBH')
+_REPORT = struct.Struct('<HHII')
+
+# Edges of a gpio further apart than this (µs) belong to different DHT11
+# frames, a frame lasts about 5 ms and the host holds the line low for 17
+FRAME_GAP_US = 10000
+# Groups with fewer edges are not DHT11 frames, e.g. the host's trigger
+MIN_FRAME_EDGES = 10
+
+# fits the 16 bit size of a record
+RECV_SIZE = 32768
+
+class RecordingPi(object):
+    def __init__(self, pi, path):
+        """
+        Wraps a pigpio connection, recording the hardware traffic through
+        it to path. Everything else is passed through.
+        MCP3008 reads go one SPI transfer at a time while recording, so
+        every frame is seen.
+        """
+        self._pi = pi
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        # records are timed by the clock the greenhouse runs by
+        self.clock = clock.of(pi)
+        self._started = self.clock.time()
+        self._pumps = []
+
+    def __getattr__(self, name):
+        if name == "sl":
+            # keeps MCP3008.read_channels off the raw socket, to spi_xfer
+            raise AttributeError(name)
+        return getattr(self._pi, name)
+
+    def record(self, kind, payload=b""):
+        data = _HEADER.pack(self.clock.time() - self._started, kind, len(payload)) + payload
+        with self._lock:
+            if self._file is not None:
+                self._file.write(data)
+
+    def record_action(self, action, **arguments):
+        """
+        Records an action of the user, e.g. record_action("set_mode",
+        name="fan", mode=ON), for the replay to repeat.
+        """
+        arguments["action"] = action
+        self.record(ACTION, json.dumps(arguments).encode("utf-8"))
+
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        if func is None:
+            return self._pi.callback(user_gpio, edge)
+
+        def recorded(gpio, level, tick):
+            self.record(EDGE, struct.pack('<BBI', gpio, level, tick))
+            func(gpio, level, tick)
+        return self._pi.callback(user_gpio, edge, recorded)
+
+    def notify_socket(self):
+        """
+        Returns (handle, socket) of a notification stream, the reports
+        recorded on their way through.
+        """
+        import notify
+        handle, upstream = notify.open_notify_socket(self._pi)
+        ours, theirs = socket.socketpair()
+        pump = threading.Thread(target=self._pump, args=(upstream, ours))
+        pump.daemon = True
+        pump.start()
+        self._pumps.append(pump)
+        return handle, theirs
+
+    def _pump(self, upstream, ours):
+        try:
+            while True:
+                data = upstream.recv(RECV_SIZE)
+                if not data:
+                    break
+                self.record(NOTIFY, data)
+                ours.sendall(data)
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+            ours.close()
+
+    def spi_open(self, spi_channel, baud, spi_flags=0):
+        handle = self._pi.spi_open(spi_channel, baud, spi_flags)
+        self.record(SPI_OPEN, struct.pack('<Bi', spi_channel, handle))
+        return handle
+
+    def spi_xfer(self, handle, data):
+        count, received = self._pi.spi_xfer(handle, data)
+        data = bytes(bytearray(data))
+        self.record(SPI, struct.pack('<iB', handle, len(data)) + data + bytes(received))
+        return count, received
+
+    def read(self, gpio):
+        level = self._pi.read(gpio)
+        self.record(READ, struct.pack('<BB', gpio, level))
+        return level
+
+    def read_bank_1(self):
+        levels = self._pi.read_bank_1()
+        self.record(READ_BANK, struct.pack('<I', levels & 0xffffffff))
+        return levels
+
+    def set_mode(self, gpio, mode):
+        self.record(MODE, struct.pack('<BB', gpio, mode))
+        return self._pi.set_mode(gpio, mode)
+
+    def write(self, gpio, level):
+        self.record(WRITE, struct.pack('<BB', gpio, level))
+        return self._pi.write(gpio, level)
+
+    def set_bank_1(self, bits):
+        self.record(BANK_SET, struct.pack('<I', bits))
+        return self._pi.set_bank_1(bits)
+
+    def clear_bank_1(self, bits):
+        self.record(BANK_CLEAR, struct.pack('<I', bits))
+        return self._pi.clear_bank_1(bits)
+
+    def wave_chain(self, data):
+        self.record(WAVE_CHAIN, bytes(bytearray(data)))
+        return self._pi.wave_chain(data)
+
+    def wave_tx_stop(self):
+        self.record(WAVE_TX_STOP)
+        return self._pi.wave_tx_stop()
+
+    def stop(self):
+        self._pi.stop()
+        for pump in self._pumps:
+            pump.join()
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+def read_records(path):
+    """
+    Yields the (time, kind, payload) records of a recording.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a greenhouse recording".format(path))
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                # the end, or a recording cut short
+                return
+            t, kind, size = _HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            yield t, kind, payload
+
+class Recording(object):
+    def __init__(self, path):
+        """
+        A recording, sorted out for replay: the edges of every gpio, the
+        DHT11 frames among them, the MCP3008 readings and the commands.
+        """
+        self.path = path
+        self.duration = 0.0
+        self.counts = collections.Counter()
+        # gpio: [(time, level, tick)]
+        self.edges = collections.defaultdict(list)
+        # levels read before the first edges, gpio: level
+        self.initial_levels = {}
+        # spi channel: channel: [(time, value)]
+        self.spi = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.commands = []
+        # [(time, {"action": name, ...arguments})]
+        self.actions = []
+        self.dht11_gpios = set()
+
+        spi_channels = {}
+        seen = set()
+        self._rest = b""
+        levels = None
+        triggered = set()
+        for t, kind, payload in read_records(path):
+            self.duration = t
+            self.counts[kind] += 1
+            if kind == EDGE:
+                gpio, level, tick = struct.unpack('<BBI', payload)
+                self._add_edge(seen, gpio, t, level, tick)
+            elif kind == NOTIFY:
+                levels = self._add_reports(seen, t, payload, levels)
+            elif kind == READ_BANK:
+                if levels is None:
+                    levels = struct.unpack('<I', payload)[0]
+                for gpio in range(32):
+                    self.initial_levels.setdefault(gpio, (levels >> gpio) & 1)
+            elif kind == READ:
+                gpio, level = struct.unpack('<BB', payload)
+                self.initial_levels.setdefault(gpio, level)
+            elif kind == SPI_OPEN:
+                channel, handle = struct.unpack('<Bi', payload)
+                spi_channels[handle] = channel
+            elif kind == SPI:
+                handle, size = struct.unpack('<iB', payload[:5])
+                sent = bytearray(payload[5:5 + size])
+                received = bytearray(payload[5 + size:])
+                if len(sent) >= 3 and sent[1] & 0x80 and len(received) >= 3:
+                    value = ((received[1] & 3) << 8) + received[2]
+                    self.spi[spi_channels.get(handle, 0)][(sent[1] >> 4) & 7].append((t, value))
+            elif kind == MODE:
+                gpio, mode = struct.unpack('<BB', payload)
+                # the host pulling a line low, then letting go of it, is
+                # a DHT11 trigger
+                if mode == pigpio.INPUT and gpio in triggered:
+                    self.dht11_gpios.add(gpio)
+            elif kind == WRITE:
+                gpio, level = struct.unpack('<BB', payload)
+                if level == 0:
+                    triggered.add(gpio)
+            elif kind == ACTION:
+                self.actions.append((t, json.loads(payload.decode("utf-8"))))
+            if kind in COMMANDS:
+                self.commands.append((t, kind, payload))
+        for edges in self.edges.values():
+            # stable, edges received together keep their order
+            edges.sort(key=lambda edge: edge[0])
+
+    def _add_edge(self, seen, gpio, t, level, tick):
+        # the same edge may come from a callback and a notification
+        if (gpio, tick, level) not in seen:
+            seen.add((gpio, tick, level))
+            self.edges[gpio].append((t, level, tick))
+
+    def _add_reports(self, seen, t, data, levels):
+        # a chunk may end part way through a report, the next one has the rest
+        data = self._rest + data
+        end = len(data) - len(data) % _REPORT.size
+        self._rest = data[end:]
+        for offset in range(0, end, _REPORT.size):
+            seq, flags, tick, level = _REPORT.unpack_from(data, offset)
+            if flags:
+                continue
+            changed = level ^ levels if levels is not None else 0
+            for gpio in range(32):
+                if changed >> gpio & 1:
+                    self._add_edge(seen, gpio, t, (level >> gpio) & 1, tick)
+            levels = level
+        return levels
+
+    def frames(self, gpio):
+        """
+        Returns the [(time, [(level, tick)])] DHT11 frames of gpio.
+        """
+        frames = []
+        group = []
+        for t, level, tick in self.edges.get(gpio, []):
+            if group and (tick - group[-1][2]) & 0xffffffff > FRAME_GAP_US:
+                frames.append(group)
+                group = []
+            group.append((t, level, tick))
+        frames.append(group)
+        return [(group[0][0], [(level, tick) for t, level, tick in group])
+                for group in frames if len(group) >= MIN_FRAME_EDGES]
+
+class ReplayDHT11(object):
+    def __init__(self, frames):
+        """
+        Answers DHT11 triggers with the recorded frame of the time.
+        frames (list): [(time, [(level, tick)])] as Recording.frames()
+        """
+        self.times = [t for t, edges in frames]
+        self.frames = [edges for t, edges in frames]
+        self.replayed = 0
+
+    def edges(self, start_tick, t, rng):
+        if not self.frames:
+            return []
+        frame = self.frames[max(bisect.bisect_right(self.times, t) - 1, 0)]
+        self.replayed += 1
+        first = frame[0][1]
+        # the recorded timing, moved to start after the host lets go
+        return [(level, (start_tick + 30 + ((tick - first) & 0xffffffff)) & 0xffffffff)
+                for level, tick in frame]
+
+class ReplayMCP3008(object):
+    def __init__(self, channels):
+        """
+        Answers SPI transfers with the last reading recorded by the time.
+        channels (dict): channel: [(time, value)]
+        """
+        self.times = {}
+        self.values = {}
+        for channel, readings in channels.items():
+            self.times[channel] = np.array([t for t, value in readings])
+            self.values[channel] = [value for t, value in readings]
+
+    def value(self, channel, t, rng):
+        times = self.times.get(channel)
+        if times is None or not len(times):
+            return 0
+        return self.values[channel][max(int(np.searchsorted(times, t, side='right')) - 1, 0)]
+
+class ReplayPi(sim_pigpio.SimPi):
+    def __init__(self, recording, speed=1.0):
+        """
+        Simulated pigpio playing a Recording back: DHT11 triggers get the
+        recorded frames, SPI transfers the recorded readings, and the
+        other inputs, e.g. the lightgate, change when they did, speed
+        times faster than recorded. The commands sent to it are kept in
+        self.commands, comparable to recording.commands.
+        """
+        if not isinstance(recording, Recording):
+            recording = Recording(recording)
+        sim_pigpio.SimPi.__init__(self, speed=speed, auto_sensors=False)
+        self.recording = recording
+        self.commands = []
+        self.finished = threading.Event()
+
+        for gpio in recording.dht11_gpios:
+            self.add_dht11(gpio, ReplayDHT11(recording.frames(gpio)))
+        for spi_channel, channels in recording.spi.items():
+            self.add_mcp3008(spi_channel, ReplayMCP3008(channels))
+
+        self._inputs = sorted(((t, gpio, level) for gpio, edges in recording.edges.items()
+                               if gpio not in recording.dht11_gpios
+                               for t, level, tick in edges), key=lambda edge: edge[0])
+        for gpio, level in recording.initial_levels.items():
+            if gpio not in recording.dht11_gpios and level:
+                self.levels |= 1 << gpio
+        self._stop_event = threading.Event()
+        self._player = threading.Thread(target=self._play)
+        self._player.daemon = True
+        self._player.start()
+        self._actor = None
+
+    def play_actions(self, greenhouse):
+        """
+        Repeats the recorded actions of the user on greenhouse when they
+        were made, so the commands they caused are sent again.
+        """
+        self._actor = threading.Thread(target=self._act, args=(greenhouse,))
+        self._actor.daemon = True
+        self._actor.start()
+
+    def _act(self, greenhouse):
+        for t, action in self.recording.actions:
+            delay = (t - self.time()) / self.speed
+            if delay > 0 and self._stop_event.wait(delay):
+                return
+            arguments = dict(action)
+            name = arguments.pop("action")
+            try:
+                getattr(greenhouse, name)(**arguments)
+            except (AttributeError, TypeError, ValueError, pigpio.error) as e:
+                events.error("replay.action_failed", action=name, error=e)
+
+    def _play(self):
+        for t, gpio, level in self._inputs:
+            delay = (t - self.time()) / self.speed
+            if delay > 0 and self._stop_event.wait(delay):
+                return
+            self._set_level(gpio, level, self.get_current_tick())
+        delay = (self.recording.duration - self.time()) / self.speed
+        if delay > 0 and self._stop_event.wait(delay):
+            return
+        self.finished.set()
+
+    def _command(self, kind, payload=b""):
+        self.commands.append((self.time(), kind, payload))
+
+    def write(self, gpio, level):
+        self._command(WRITE, struct.pack('<BB', gpio, level))
+        return sim_pigpio.SimPi.write(self, gpio, level)
+
+    def set_bank_1(self, bits):
+        self._command(BANK_SET, struct.pack('<I', bits))
+        return sim_pigpio.SimPi.set_bank_1(self, bits)
+
+    def clear_bank_1(self, bits):
+        self._command(BANK_CLEAR, struct.pack('<I', bits))
+        return sim_pigpio.SimPi.clear_bank_1(self, bits)
+
+    def wave_chain(self, data):
+        self._command(WAVE_CHAIN, bytes(bytearray(data)))
+        return sim_pigpio.SimPi.wave_chain(self, data)
+
+    def wave_tx_stop(self):
+        self._command(WAVE_TX_STOP)
+        return sim_pigpio.SimPi.wave_tx_stop(self)
+
+    def stop(self):
+        self._stop_event.set()
+        self._player.join()
+        if self._actor is not None:
+            self._actor.join()
+        sim_pigpio.SimPi.stop(self)
+
+def _compared(commands, ignore_gpios):
+    for t, kind, payload in commands:
+        if kind == WRITE and struct.unpack('<BB', payload)[0] in ignore_gpios:
+            continue
+        yield kind
+
+def compare_commands(recorded, replayed, ignore_gpios=()):
+    """
+    Returns {kind name: (recorded, replayed)} command counts, for the
+    kinds where they differ.
+    ignore_gpios: gpios whose writes are left out, e.g. the DHT11
+        triggers, as many as there were reads in the time replayed
+    """
+    recorded = collections.Counter(_compared(recorded, ignore_gpios))
+    replayed = collections.Counter(_compared(replayed, ignore_gpios))
+    return dict((KIND_NAMES[kind], (recorded[kind], replayed[kind]))
+                for kind in COMMANDS if recorded[kind] != replayed[kind])
+
+def main(argv=None):
+    import argparse
+    import greenhouse
+
+    parser = argparse.ArgumentParser(description="Replay a greenhouse recording without a Pi")
+    parser.add_argument("path", help="recording to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="times faster than recorded")
+    args = parser.parse_args(argv)
+
+    recording = Recording(args.path)
+    print("{}: {:.1f} s, {}".format(args.path, recording.duration, ", ".join(
+        "{} {}".format(count, KIND_NAMES.get(kind, kind)) for kind, count in sorted(recording.counts.items()))))
+    pi = ReplayPi(recording, speed=args.speed)
+    house = greenhouse.Greenhouse(pi)
+    house.start()
+    pi.play_actions(house)
+    try:
+        pi.finished.wait()
+    except KeyboardInterrupt:
+        pass
+    house.stop()
+    pi.stop()
+
+    for gpio in sorted(recording.dht11_gpios):
+        sensor = pi.dht11[gpio]
+        print("DHT11 on {}: {} frames recorded, {} replayed".format(gpio, len(sensor.frames), sensor.replayed))
+    # the outputs and the door, the DHT11 triggers depend on the read timing
+    differences = compare_commands(recording.commands, pi.commands, recording.dht11_gpios)
+    if not differences:
+        print("commands: same as recorded")
+        return 0
+    for name, (recorded, replayed) in sorted(differences.items()):
+        print("commands: {} {} recorded, {} replayed".format(name, recorded, replayed))
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Local socket between the greenhouse daemon and its user interfaces.
+
+Messages are JSON objects, one per line. A client sends commands
+    {"cmd": "subscribe", "history_s": 3600}
+    {"cmd": "set_mode", "name": "lamp", "mode": 2}
+    {"cmd": "toggle_door"}
+    {"cmd": "cancel_door"}
+and gets back
+    {"type": "history", "times": ..., "values": ..., "columns": 13}
+    {"type": "state", "state": {...}}
+    {"type": "error", "message": "..."}
+Subscribing sends the recent history once, then every new state. A slow
+client only ever misses states, it never holds up the daemon.
+"""
+import base64
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import numpy as np
+
+SOCKET_PATH = os.environ.get(
+    "GREENHOUSE_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), "greenhouse.sock"))
+
+RECONNECT_INTERVAL_S = 1.0
+
+def encode_array(values):
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<f8').tobytes()).decode("ascii")
+
+def decode_array(text, columns=None):
+    values = np.frombuffer(base64.b64decode(text), dtype='<f8')
+    if columns is not None:
+        values = values.reshape(-1, columns)
+    return values
+
+def _encode(message):
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+class _Connection(object):
+    def __init__(self, server, sock):
+        """
+        One client of the server. Replies are queued, states conflated to
+        the latest one, and both are sent by the connection's own writer.
+        """
+        self.server = server
+        self.sock = sock
+        self.subscribed = False
+        self._replies = []
+        self._state = None
+        self._closed = False
+        self._wake = threading.Condition()
+
+    def send(self, data):
+        with self._wake:
+            self._replies.append(data)
+            self._wake.notify()
+
+    def post_state(self, data):
+        with self._wake:
+            self._state = data
+            self._wake.notify()
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_loop(self):
+        try:
+            while True:
+                with self._wake:
+                    while not self._replies and self._state is None and not self._closed:
+                        self._wake.wait()
+                    if self._closed:
+                        return
+                    data = b"".join(self._replies)
+                    if self._state is not None:
+                        data += self._state
+                    self._replies = []
+                    self._state = None
+                self.sock.sendall(data)
+        except OSError:
+            self.close()
+
+    def read_loop(self):
+        try:
+            for line in self.sock.makefile("rb"):
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                    self.server.handle(self, message)
+                except Exception as e:
+                    self.send(_encode({"type": "error", "message": str(e)}))
+        except OSError:
+            pass
+        finally:
+            self.close()
+            self.server.remove(self)
+            self.sock.close()
+
+class Server(object):
+    def __init__(self, greenhouse, path=SOCKET_PATH):
+        """
+        Serves a greenhouse.Greenhouse to clients on a Unix socket.
+        """
+        self.greenhouse = greenhouse
+        self.path = path
+        self._sock = None
+        self._accepter = None
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._sock is not None:
+            return
+        if os.path.exists(self.path):
+            # left over from a daemon that did not shut down, unless one
+            # is still answering on it
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError("a greenhouse daemon is already running on {}".format(self.path))
+            except (OSError, socket.error):
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(8)
+        self.greenhouse.subscribe(self.on_state)
+        self._accepter = threading.Thread(target=self._accept_loop)
+        self._accepter.daemon = True
+        self._accepter.start()
+
+    def stop(self):
+        if self._sock is None:
+            return
+        self.greenhouse.unsubscribe(self.on_state)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._accepter.join()
+        self._sock = None
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, address = self._sock.accept()
+            except OSError:
+                return
+            connection = _Connection(self, sock)
+            with self._lock:
+                self._connections.append(connection)
+            for target in (connection.read_loop, connection.write_loop):
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+
+    def remove(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+
+    def on_state(self, state):
+        # encoded once for every client
+        data = _encode({"type": "state", "state": state})
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            if connection.subscribed:
+                connection.post_state(data)
+
+    def handle(self, connection, message):
+        cmd = message.get("cmd")
+        if cmd == "subscribe":
+            seconds = float(message.get("history_s", 0))
+            if seconds > 0:
+                times, values = self.greenhouse.history.last_raw(seconds, self.greenhouse.clock.time())
+                connection.send(_encode({
+                    "type": "history",
+                    "columns": values.shape[1],
+                    "times": encode_array(times),
+                    "values": encode_array(values),
+                }))
+            connection.subscribed = True
+            if self.greenhouse.state is not None:
+                connection.post_state(_encode({"type": "state", "state": self.greenhouse.state}))
+        elif cmd == "set_mode":
+            self.greenhouse.set_mode(message["name"], int(message["mode"]))
+        elif cmd == "toggle_door":
+            self.greenhouse.toggle_door()
+        elif cmd == "cancel_door":
+            self.greenhouse.cancel_door()
+        else:
+            raise ValueError("unknown command {}".format(cmd))
+
+class Client(object):
+    def __init__(self, on_message, path=SOCKET_PATH, history_s=0):
+        """
+        Connects to a greenhouse daemon and calls on_message(message) from
+        its reader thread for every message. Reconnects by itself when the
+        daemon goes away, on_message gets {"type": "disconnected"} then.
+        history_s (float): history to ask for on every (re)connect
+        """
+        self.on_message = on_message
+        self.path = path
+        self.history_s = history_s
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._closing = False
+        self._reader = None
+
+    def connect(self):
+        """
+        Connects once, raises OSError if no daemon is listening.
+        """
+        self._open()
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self.request("subscribe", history_s=self.history_s)
+
+    def request(self, cmd, **kwargs):
+        kwargs["cmd"] = cmd
+        data = _encode(kwargs)
+        with self._send_lock:
+            sock = self._sock
+            if sock is None:
+                return False
+            try:
+                sock.sendall(data)
+            except OSError:
+                return False
+        return True
+
+    def set_mode(self, name, mode):
+        return self.request("set_mode", name=name, mode=mode)
+
+    def toggle_door(self):
+        return self.request("toggle_door")
+
+    def cancel_door(self):
+        return self.request("cancel_door")
+
+    def _read_loop(self):
+        while not self._closing:
+            try:
+                for line in self._sock.makefile("rb"):
+                    self.on_message(json.loads(line.decode("utf-8")))
+            except OSError:
+                pass
+            if self._closing:
+                return
+            with self._send_lock:
+                self._sock.close()
+                self._sock = None
+            self.on_message({"type": "disconnected"})
+            while not self._closing:
+                time.sleep(RECONNECT_INTERVAL_S)
+                try:
+                    self._open()
+                    break
+                except OSError:
+                    pass
+
+    def close(self):
+        self._closing = True
+        with self._send_lock:
+            if self._sock is not None:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,117 @@
+"""
+Sensor readings shared by every consumer, the sampling tick, the control
+loop and the log, from a single acquisition.
+"""
+import collections
+import threading
+import backend
+from clock import WALL
+import events
+import metrics
+
+ACQUISITIONS = metrics.counter("greenhouse_sensor_acquisitions_total",
+                               "Sensor acquisitions by result", ("sensor", "result"))
+CACHE_HITS = metrics.counter("greenhouse_sensor_cache_hits_total",
+                             "Readings served from the cache without an acquisition", ("sensor",))
+
+# The latest value of a sensor, see SensorCache.peek()
+Reading = collections.namedtuple('Reading', ['value', 'timestamp', 'valid', 'stale'])
+
+class SensorCache(object):
+    def __init__(self, name, acquire, ttl, min_interval=0.0, max_age=None,
+                 retry_min_s=None, retry_max_s=None, clock=None):
+        """
+        Serves the readings of one sensor, acquiring a new one only once
+        the cached one is older than ttl, so every consumer within ttl
+        shares one acquisition. A failed acquisition is retried after
+        retry_min_s, doubling up to retry_max_s, and never sooner than
+        min_interval after the last one; until then the last good value
+        is served, marked not valid.
+        name (str): sensor name, for the metrics
+        acquire(): returns a new value, None or raises one of
+            backend.CONNECTION_ERRORS when the sensor could not be read
+        ttl (float): seconds a value is served before acquiring again
+        min_interval (float): least seconds between two acquisitions
+            the sensor allows
+        max_age (float): seconds after which a value is stale, 3 ttl by
+            default
+        retry_min_s, retry_max_s (float): retry delays after failures,
+            the larger of ttl and min_interval and 8 times that by
+            default
+        clock (clock.Clock): times the readings, the wall clock when None
+        """
+        self.name = name
+        self.clock = clock or WALL
+        self.acquire = acquire
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.max_age = max_age if max_age is not None else 3 * max(ttl, min_interval)
+        self.retry_min_s = retry_min_s if retry_min_s is not None else max(ttl, min_interval)
+        self.retry_max_s = retry_max_s if retry_max_s is not None else 8 * self.retry_min_s
+        self.failures = 0
+        self.last_error = None
+        # earliest time of the next acquisition
+        self.next_attempt = 0.0
+        # (value, timestamp, valid) rebound as a whole so peek() never
+        # needs the lock an acquisition holds
+        self._last = (None, None, False)
+        self._lock = threading.Lock()
+        self._ok = ACQUISITIONS.labels(name, "ok")
+        self._failed = ACQUISITIONS.labels(name, "failed")
+        self._hits = CACHE_HITS.labels(name)
+
+    def peek(self, now=None):
+        """
+        Returns the latest Reading without ever acquiring: value and
+        timestamp of the last good acquisition (None before the first),
+        valid False when the acquisitions since have failed, and stale
+        True when there is no value or it is older than max_age.
+        """
+        value, timestamp, valid = self._last
+        now = self.clock.time() if now is None else now
+        stale = timestamp is None or now - timestamp > self.max_age
+        return Reading(value, timestamp, valid, stale)
+
+    def get(self, ttl=None):
+        """
+        Returns the latest Reading, acquiring first if the cached one has
+        outlived ttl or a retry is due. Consumers calling at the same
+        time wait for, and share, the one acquisition.
+        ttl (float): a consumer content with older readings than the
+            cache's ttl passes its own
+        """
+        with self._lock:
+            now = self.clock.time()
+            value, timestamp, valid = self._last
+            if now < self.next_attempt or (ttl is not None and valid and now - timestamp < ttl):
+                self._hits.inc()
+            else:
+                self._refresh()
+        return self.peek()
+
+    def _refresh(self):
+        started = self.clock.time()
+        try:
+            value = self.acquire()
+            error = None if value is not None else "no reading"
+        except backend.CONNECTION_ERRORS as e:
+            value = None
+            error = e
+        if error is None:
+            self.failures = 0
+            self.last_error = None
+            self._last = (value, started, True)
+            self.next_attempt = started + max(self.ttl, self.min_interval)
+            self._ok.inc()
+            return
+        self.failures += 1
+        self.last_error = error
+        value, timestamp, valid = self._last
+        self._last = (value, timestamp, False)
+        retry = min(self.retry_min_s * 2 ** (self.failures - 1), self.retry_max_s)
+        self.next_attempt = started + max(retry, self.min_interval)
+        self._failed.inc()
+        if isinstance(error, Exception):
+            # a sensor returning None reports its failures itself
+            events.error("sensor.acquire_failed", sensor=self.name, error=error,
+                         retry_s=round(self.next_attempt - started, 1))
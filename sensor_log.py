@@ -0,0 +1,196 @@
+import os
+import threading
+import numpy as np
+import history
+
+LOG_DIR = os.environ.get(
+    "GREENHOUSE_LOG_DIR",
+    os.path.join(os.path.expanduser("~"), ".local", "share", "greenhouse", "log"))
+
+# One fixed width record per history row
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('values', '<f4', (history.NUM_COLUMNS,)),
+])
+
+# About 8 MB per segment at the 200 ms UI tick rate
+SEGMENT_RECORDS = 128 * 1024
+# Records written at once, SD cards prefer rare, large sequential writes
+FLUSH_INTERVAL_S = 60.0
+BATCH_RECORDS = 4096
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".rec"
+
+def _segment_name(t):
+    return "{}{:017.6f}{}".format(SEGMENT_PREFIX, t, SEGMENT_SUFFIX)
+
+class SensorLog(object):
+    def __init__(self, directory=LOG_DIR, flush_interval=FLUSH_INTERVAL_S,
+                 segment_records=SEGMENT_RECORDS, batch_records=BATCH_RECORDS):
+        """
+        Append-only on-disk log of history rows.
+        Rows are queued by append() and written in batches by a background
+        thread to segment files of fixed width records, named after the
+        time of their first record. A partial record left at the end of the
+        last segment by a power loss is cut off when the log is opened.
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.segment_records = segment_records
+        self.dropped = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._segments = self._scan()
+        self._maps = {}
+        self._repair_last_segment()
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = np.zeros(batch_records, dtype=RECORD_DTYPE)
+        self._spare = np.zeros(batch_records, dtype=RECORD_DTYPE)
+        self._num_pending = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _scan(self):
+        """
+        Returns [(start_time, path)] of the segments, oldest first.
+        """
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                start = float(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                segments.append((start, os.path.join(self.directory, name)))
+        segments.sort()
+        return segments
+
+    def _repair_last_segment(self):
+        if not self._segments:
+            return
+        path = self._segments[-1][1]
+        size = os.path.getsize(path)
+        if size % RECORD_DTYPE.itemsize:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % RECORD_DTYPE.itemsize)
+
+    def append(self, t, row):
+        """
+        Queues a row taken at time t for writing, never blocks on the disk.
+        If the writer falls a whole batch behind, rows are dropped and
+        counted in self.dropped.
+        """
+        with self._lock:
+            if self._num_pending == len(self._pending):
+                self.dropped += 1
+                return
+            record = self._pending[self._num_pending]
+            record['time'] = t
+            record['values'] = row
+            self._num_pending += 1
+            if self._num_pending == len(self._pending):
+                self._wake.set()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if self._stopping:
+                return
+
+    def flush(self):
+        """
+        Writes the queued rows to disk.
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            batch = self._pending[:self._num_pending]
+            self._pending, self._spare = self._spare, self._pending
+            self._num_pending = 0
+        while len(batch):
+            path, room = self._active_segment(batch['time'][0])
+            chunk = batch[:room]
+            with open(path, "ab") as f:
+                f.write(chunk.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            batch = batch[room:]
+
+    def _active_segment(self, t):
+        """
+        Returns (path, records that still fit) of the segment to append
+        to, starting a new one at time t when the last one is full.
+        """
+        if self._segments:
+            path = self._segments[-1][1]
+            used = os.path.getsize(path) // RECORD_DTYPE.itemsize
+            if used < self.segment_records:
+                return path, self.segment_records - used
+        path = os.path.join(self.directory, _segment_name(t))
+        self._segments.append((t, path))
+        return path, self.segment_records
+
+    def _map(self, path, is_last):
+        """
+        Memory maps a segment. Full segments never change and stay mapped,
+        the one being appended to is mapped again to see new records.
+        """
+        records = self._maps.get(path)
+        if records is None or is_last:
+            size = os.path.getsize(path) // RECORD_DTYPE.itemsize
+            if size == 0:
+                return np.zeros(0, dtype=RECORD_DTYPE)
+            records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(size,))
+            if not is_last:
+                self._maps[path] = records
+        return records
+
+    def ranges(self, start, end):
+        """
+        Returns the records with start <= time < end that are on disk, as a
+        list of read-only views into the memory mapped segments, oldest
+        first. Nothing is parsed or copied.
+        """
+        segments = list(self._segments)
+        views = []
+        for i, (segment_start, path) in enumerate(segments):
+            if segment_start >= end:
+                break
+            is_last = i == len(segments) - 1
+            if not is_last and segments[i + 1][0] <= start:
+                continue
+            records = self._map(path, is_last)
+            times = records['time']
+            first = np.searchsorted(times, start, side='left')
+            last = np.searchsorted(times, end, side='left')
+            if last > first:
+                views.append(records[first:last])
+        return views
+
+    def query(self, start, end):
+        """
+        Same as ranges() as a single array. Only copies when the range
+        spans several segments.
+        """
+        views = self.ranges(start, end)
+        if not views:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views)
+
+    def close(self):
+        """
+        Writes what is queued and stops the writer.
+        """
+        self._stopping = True
+        self._wake.set()
+        self._writer.join()
@@ -0,0 +1,568 @@
+import math
+import random
+import socket
+import struct
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import pigpio
+import clock
+
+# pigpio limits the simulated waves are held to
+MAX_WAVES = 250
+MAX_WAVE_PULSES = 12000
+MAX_WAVE_CBS = 25016
+MAX_WAVE_MICROS = 1800000000
+MAX_CHAIN_ENTRIES = 600
+MAX_CHAIN_LOOPS = 20
+
+# A DHT11 trigger only counts if the line was pulled low this recently
+DHT11_TRIGGER_WINDOW_S = 1.0
+
+def _error(code):
+    raise pigpio.error(pigpio.error_text(code))
+
+def _waveform(value, t):
+    if callable(value):
+        return value(t)
+    return value
+
+def daily(mean, amplitude, phase_s=0.0):
+    """
+    Returns a waveform swinging sinusoidally around mean once a day.
+    """
+    def waveform(t):
+        return mean + amplitude * math.sin(2 * math.pi * (t + phase_s) / 86400.0)
+    return waveform
+
+def drying(wet, dry, period_s):
+    """
+    Returns a sawtooth waveform drying out from wet to dry over period_s,
+    then being watered back to wet.
+    """
+    def waveform(t):
+        return wet + (dry - wet) * ((t % period_s) / period_s)
+    return waveform
+
+class SimDHT11(object):
+    def __init__(self, temperature=None, humidity=None, jitter_us=4, checksum_error_rate=0.0,
+                 drop_rate=0.0):
+        """
+        Simulated DHT11, answers a trigger with a frame of edges.
+        temperature, humidity (float or callable): value, or waveform of
+            the simulated time in seconds
+        jitter_us (int): random jitter added to every pulse
+        checksum_error_rate (float): share of frames with a flipped bit
+        drop_rate (float): chance of losing each edge
+        """
+        self.temperature = daily(22.0, 3.0) if temperature is None else temperature
+        self.humidity = daily(55.0, 10.0, phase_s=43200.0) if humidity is None else humidity
+        self.jitter_us = jitter_us
+        self.checksum_error_rate = checksum_error_rate
+        self.drop_rate = drop_rate
+
+    def frame(self, t, rng):
+        humidity = min(max(_waveform(self.humidity, t), 0.0), 99.9)
+        temperature = min(max(_waveform(self.temperature, t), -50.0), 50.0)
+        sign = 0x80 if temperature < 0 else 0
+        humidity = int(round(humidity * 10))
+        temperature = int(round(abs(temperature) * 10))
+        data = [humidity // 10, humidity % 10, temperature // 10, (temperature % 10) | sign]
+        data.append(sum(data) & 0xff)
+        if rng.random() < self.checksum_error_rate:
+            data[rng.randrange(4)] ^= 1 << rng.randrange(8)
+        return data
+
+    def edges(self, start_tick, t, rng):
+        """
+        Returns the (level, tick) edges of a frame, starting after the
+        host releases the line at start_tick.
+        """
+        jitter = self.jitter_us
+        tick = start_tick
+        edges = []
+
+        def edge(level, after_us):
+            edges.append((level, tick + after_us + rng.randint(-jitter, jitter)))
+            return edges[-1][1]
+
+        # response: low 80 µs, high 80 µs
+        tick = edge(0, 30)
+        tick = edge(1, 80)
+        tick = edge(0, 80)
+        for byte in self.frame(t, rng):
+            for bit in range(7, -1, -1):
+                tick = edge(1, 50)
+                tick = edge(0, 70 if byte >> bit & 1 else 26)
+        edge(1, 50)
+        if self.drop_rate:
+            edges = [e for e in edges if rng.random() >= self.drop_rate]
+        return [(level, tick & 0xffffffff) for level, tick in edges]
+
+class SimMCP3008(object):
+    def __init__(self, channels=None, noise=2.0):
+        """
+        Simulated MCP3008.
+        channels (list): 8 values or waveforms of the simulated time
+        noise (float): standard deviation of the noise added to readings
+        """
+        if channels is None:
+            channels = [drying(350 + 20 * i, 750 + 10 * i, 86400.0 * (1 + i % 3))
+                        for i in range(8)]
+        self.channels = channels
+        self.noise = noise
+
+    def value(self, channel, t, rng):
+        value = _waveform(self.channels[channel], t) + rng.gauss(0, self.noise)
+        return int(min(max(round(value), 0), 1023))
+
+class SimDoor(object):
+    def __init__(self, pin_step, pin_dir, lightgate_gpio, blocked_level=0, closing_level=1):
+        """
+        Simulated door moved by the steps of the waves sent, with a
+        lightgate blocked while the door is at its closed end. The door
+        starts closed and does not go past it.
+        pin_step, pin_dir (int): gpios of the stepper driver
+        lightgate_gpio (int): gpio of the lightgate
+        blocked_level (int): level of the lightgate while it is blocked
+        closing_level (int): level of pin_dir moving towards the closed end
+        """
+        self.pin_step = pin_step
+        self.pin_dir = pin_dir
+        self.lightgate_gpio = lightgate_gpio
+        self.blocked_level = blocked_level
+        self.closing_level = closing_level
+        # steps from the closed end
+        self.position = 0.0
+        # (started, duration, steps, direction) of the waves moving it
+        self.move = None
+
+    def position_at(self, now):
+        if self.move is None:
+            return self.position
+        started, duration, steps, direction = self.move
+        done = steps * min((now - started) / duration, 1.0) if duration else steps
+        return max(self.position + direction * done, 0.0)
+
+    def crossing(self):
+        """
+        Seconds after the start of the move at which the door enters or
+        leaves the lightgate, None if it does not.
+        """
+        started, duration, steps, direction = self.move
+        if not steps:
+            return None
+        if direction > 0 and self.position <= 0:
+            # leaves it with the first step
+            return duration / steps
+        if direction < 0 and 0 < self.position <= steps:
+            return duration * self.position / steps
+        return None
+
+class _SimCallback(object):
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+        self.count = 0
+
+    def cancel(self):
+        with self.pi._lock:
+            if self in self.pi._callbacks:
+                self.pi._callbacks.remove(self)
+
+    def tally(self):
+        return self.count
+
+class SimPi(object):
+    def __init__(self, speed=1.0, seed=None, auto_sensors=True):
+        """
+        In-process stand-in for pigpio.pi.
+        Sensors are simulated from waveforms of the simulated time, which
+        runs speed times faster than real time, and so do the waves and
+        self.clock, the clock the greenhouse then runs by. Callbacks are called from a dispatcher thread like pigpio's.
+        speed (float): simulated seconds per real second
+        seed (int): random seed, for repeatable runs
+        auto_sensors (bool): answer DHT11 triggers and SPI transfers with
+            default simulated sensors when none were added
+        """
+        self.connected = True
+        self.speed = speed
+        self.rng = random.Random(seed)
+        self.auto_sensors = auto_sensors
+        self.clock = clock.ScaledClock(speed)
+
+        self.modes = {}
+        self.levels = 0
+        self.dht11 = {}
+        self.mcp3008 = {}
+        self._low_since = {}
+        self._spi = {}
+        self._next_spi_handle = 0
+
+        self._lock = threading.RLock()
+        self._callbacks = []
+        # notification handle: [bits, socket]
+        self._notify = {}
+        self._notify_seq = 0
+        self._events = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+        self._pending_pulses = []
+        self._waves = {}
+        self._tx_end = 0.0
+        self.wave_chains = 0
+        self.door = None
+        self._door_timer = None
+
+    # -- simulated time
+
+    def time(self):
+        """
+        Simulated seconds since this SimPi was created.
+        """
+        return self.clock.elapsed()
+
+    def get_current_tick(self):
+        return int(self.time() * 1000000) & 0xffffffff
+
+    # -- simulated hardware
+
+    def add_dht11(self, gpio, sensor=None):
+        self.dht11[gpio] = sensor or SimDHT11()
+        return self.dht11[gpio]
+
+    def add_mcp3008(self, spi_channel=0, sensor=None):
+        self.mcp3008[spi_channel] = sensor or SimMCP3008()
+        return self.mcp3008[spi_channel]
+
+    def add_door(self, pin_step, pin_dir, lightgate_gpio, blocked_level=0, closing_level=1):
+        self.door = SimDoor(pin_step, pin_dir, lightgate_gpio, blocked_level, closing_level)
+        self.set_input(lightgate_gpio, blocked_level)
+        return self.door
+
+    def set_input(self, gpio, level):
+        """
+        Drives an input from outside, e.g. a lightgate.
+        """
+        self._set_level(gpio, level, self.get_current_tick())
+
+    def _set_level(self, gpio, level, tick):
+        bit = 1 << gpio
+        with self._lock:
+            if bool(self.levels & bit) == bool(level):
+                return
+            if level:
+                self.levels |= bit
+            else:
+                self.levels &= ~bit
+            for bits, sock in self._notify.values():
+                if bits & bit:
+                    sock.sendall(struct.pack('<HHII', self._notify_seq, 0, tick & 0xffffffff,
+                                             self.levels & 0xffffffff))
+                    self._notify_seq = (self._notify_seq + 1) & 0xffff
+        self._events.put((gpio, int(bool(level)), tick))
+
+    def _dispatch(self):
+        while True:
+            gpio, level, tick = self._events.get()
+            if gpio is None:
+                return
+            with self._lock:
+                callbacks = [cb for cb in self._callbacks if cb.gpio == gpio]
+            for cb in callbacks:
+                if (cb.edge == pigpio.EITHER_EDGE or (cb.edge == pigpio.RISING_EDGE and level == 1)
+                        or (cb.edge == pigpio.FALLING_EDGE and level == 0)):
+                    cb.count += 1
+                    if cb.func is not None:
+                        cb.func(gpio, level, tick)
+
+    # -- basic gpio
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+        if mode == pigpio.INPUT:
+            low_since = self._low_since.pop(gpio, None)
+            if low_since is not None and time.time() - low_since < DHT11_TRIGGER_WINDOW_S:
+                self._trigger_dht11(gpio)
+        return 0
+
+    def get_mode(self, gpio):
+        return self.modes.get(gpio, pigpio.INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        return 0
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        return 0
+
+    def set_glitch_filter(self, user_gpio, steady):
+        # simulated inputs are clean
+        return 0
+
+    def read(self, gpio):
+        return int(bool(self.levels & (1 << gpio)))
+
+    def write(self, gpio, level):
+        self.modes[gpio] = pigpio.OUTPUT
+        if level:
+            self._low_since.pop(gpio, None)
+        else:
+            self._low_since[gpio] = time.time()
+        self._set_level(gpio, level, self.get_current_tick())
+        return 0
+
+    def read_bank_1(self):
+        return self.levels & 0xffffffff
+
+    def set_bank_1(self, bits):
+        tick = self.get_current_tick()
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self._set_level(gpio, 1, tick)
+        return 0
+
+    def clear_bank_1(self, bits):
+        tick = self.get_current_tick()
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self._set_level(gpio, 0, tick)
+        return 0
+
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        cb = _SimCallback(self, user_gpio, edge, func)
+        with self._lock:
+            self._callbacks.append(cb)
+        return cb
+
+    def _trigger_dht11(self, gpio):
+        sensor = self.dht11.get(gpio)
+        if sensor is None:
+            if not self.auto_sensors:
+                return
+            sensor = self.add_dht11(gpio)
+        tick = self.get_current_tick()
+        # the pull-up takes the line high when the host lets go
+        self._set_level(gpio, 1, tick)
+        for level, edge_tick in sensor.edges(tick, self.time(), self.rng):
+            self._set_level(gpio, level, edge_tick)
+
+    # -- notifications
+
+    def notify_socket(self):
+        """
+        Returns (handle, socket) of a new notification stream, sending
+        pigpio's 12 byte level change reports like pigpiod does.
+        """
+        ours, theirs = socket.socketpair()
+        with self._lock:
+            handle = max(self._notify) + 1 if self._notify else 0
+            self._notify[handle] = [0, ours]
+        return handle, theirs
+
+    def notify_begin(self, handle, bits):
+        with self._lock:
+            if handle not in self._notify:
+                _error(pigpio.PI_BAD_HANDLE)
+            self._notify[handle][0] = bits
+        return 0
+
+    def notify_pause(self, handle):
+        return self.notify_begin(handle, 0)
+
+    def notify_close(self, handle):
+        with self._lock:
+            entry = self._notify.pop(handle, None)
+        if entry is None:
+            _error(pigpio.PI_BAD_HANDLE)
+        entry[1].close()
+        return 0
+
+    # -- spi
+
+    def spi_open(self, spi_channel, baud, spi_flags=0):
+        if spi_channel not in self.mcp3008 and self.auto_sensors:
+            self.add_mcp3008(spi_channel)
+        handle = self._next_spi_handle
+        self._next_spi_handle += 1
+        self._spi[handle] = spi_channel
+        return handle
+
+    def spi_close(self, handle):
+        if self._spi.pop(handle, None) is None:
+            _error(pigpio.PI_BAD_HANDLE)
+        return 0
+
+    def spi_xfer(self, handle, data):
+        if handle not in self._spi:
+            _error(pigpio.PI_BAD_HANDLE)
+        data = bytearray(data)
+        sensor = self.mcp3008.get(self._spi[handle])
+        if sensor is None or len(data) < 3 or not data[1] & 0x80:
+            return len(data), bytearray(len(data))
+        value = sensor.value((data[1] >> 4) & 7, self.time(), self.rng)
+        return 3, bytearray([0, (value >> 8) & 3, value & 0xff])
+
+    # -- waves
+
+    def wave_clear(self):
+        self._pending_pulses = []
+        self._waves = {}
+        return 0
+
+    def wave_add_new(self):
+        self._pending_pulses = []
+        return 0
+
+    def wave_add_generic(self, pulses):
+        self._pending_pulses.extend(pulses)
+        return len(self._pending_pulses)
+
+    def wave_create(self):
+        pulses = self._pending_pulses
+        self._pending_pulses = []
+        if not pulses:
+            _error(pigpio.PI_EMPTY_WAVEFORM)
+        used = sum(wave[1] for wave in self._waves.values())
+        if used + len(pulses) > MAX_WAVE_PULSES:
+            _error(pigpio.PI_TOO_MANY_PULSES)
+        for wid in range(MAX_WAVES):
+            if wid not in self._waves:
+                # duration, pulses, and the gpios switched on with the count of each
+                switched = {}
+                for p in pulses:
+                    if p.gpio_on:
+                        switched[p.gpio_on] = switched.get(p.gpio_on, 0) + 1
+                self._waves[wid] = (sum(p.delay for p in pulses), len(pulses), switched)
+                return wid
+        _error(pigpio.PI_NO_WAVEFORM_ID)
+
+    def wave_delete(self, wave_id):
+        if self._waves.pop(wave_id, None) is None:
+            _error(pigpio.PI_BAD_WAVE_ID)
+        return 0
+
+    def wave_send_once(self, wave_id):
+        return self.wave_chain([wave_id])
+
+    def wave_chain(self, data):
+        """
+        Checks the chain against pigpio's limits and keeps the transmitter
+        busy for as long as the chain would take.
+        """
+        data = list(bytearray(data))
+        if len(data) > MAX_CHAIN_ENTRIES:
+            _error(pigpio.PI_CHAIN_TOO_BIG)
+        step_bit = 1 << self.door.pin_step if self.door is not None else 0
+        # [µs, steps] of the chain and of the loops being repeated
+        totals = [[0, 0]]
+        loops = 0
+        i = 0
+        while i < len(data):
+            if data[i] != 255:
+                wave = self._waves.get(data[i])
+                if wave is None:
+                    _error(pigpio.PI_BAD_WAVE_ID)
+                totals[-1][0] += wave[0]
+                totals[-1][1] += sum(n for bits, n in wave[2].items() if bits & step_bit)
+                i += 1
+                continue
+            cmd = data[i + 1] if i + 1 < len(data) else None
+            if cmd == 0:
+                totals.append([0, 0])
+                i += 2
+            elif cmd == 1:
+                if len(totals) < 2 or i + 3 >= len(data):
+                    _error(pigpio.PI_BAD_CHAIN_LOOP)
+                loops += 1
+                if loops > MAX_CHAIN_LOOPS:
+                    _error(pigpio.PI_CHAIN_COUNTER)
+                micros, steps = totals.pop()
+                count = data[i + 2] | data[i + 3] << 8
+                totals[-1][0] += micros * count
+                totals[-1][1] += steps * count
+                i += 4
+            elif cmd == 2:
+                if i + 3 >= len(data):
+                    _error(pigpio.PI_BAD_CHAIN_DELAY)
+                totals[-1][0] += data[i + 2] | data[i + 3] << 8
+                i += 4
+            elif cmd == 3:
+                totals[-1][0] = float("inf")
+                i += 2
+            else:
+                _error(pigpio.PI_BAD_CHAIN_CMD)
+        if len(totals) != 1:
+            _error(pigpio.PI_BAD_CHAIN_LOOP)
+
+        micros, steps = totals[0]
+        self.wave_chains += 1
+        now = time.time()
+        self._tx_end = now + micros / 1000000.0 / self.speed
+        if self.door is not None and steps and micros != float("inf"):
+            self._move_door(now, micros / 1000000.0 / self.speed, steps)
+        return 0
+
+    def wave_tx_busy(self):
+        return int(time.time() < self._tx_end)
+
+    def wave_tx_stop(self):
+        self._tx_end = 0.0
+        if self.door is not None:
+            self._stop_door(time.time())
+        return 0
+
+    # -- the door
+
+    def _move_door(self, now, duration, steps):
+        door = self.door
+        closing = self.read(door.pin_dir) == door.closing_level
+        with self._lock:
+            self._stop_door(now)
+            door.move = (now, duration, steps, -1 if closing else 1)
+            crossing = door.crossing()
+            if crossing is not None:
+                blocked = closing
+                self._door_timer = threading.Timer(crossing, self._door_crossed,
+                                                   args=(door.move, blocked))
+                self._door_timer.daemon = True
+                self._door_timer.start()
+
+    def _stop_door(self, now):
+        door = self.door
+        with self._lock:
+            if self._door_timer is not None:
+                self._door_timer.cancel()
+                self._door_timer = None
+            if door.move is not None:
+                door.position = door.position_at(now)
+                door.move = None
+
+    def _door_crossed(self, move, blocked):
+        door = self.door
+        with self._lock:
+            if door.move is not move:
+                return
+            level = door.blocked_level if blocked else 1 - door.blocked_level
+            self.set_input(door.lightgate_gpio, level)
+
+    def wave_get_max_pulses(self):
+        return MAX_WAVE_PULSES
+
+    def wave_get_max_cbs(self):
+        return MAX_WAVE_CBS
+
+    def wave_get_max_micros(self):
+        return MAX_WAVE_MICROS
+
+    def stop(self):
+        self.connected = False
+        if self.door is not None:
+            self._stop_door(time.time())
+        self._events.put((None, None, None))
@@ -0,0 +1,83 @@
+"""
+Startup phase timing. Cheap to import on purpose, import it first.
+"""
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# GREENHOUSE_STARTUP_REPORT=1 or --startup-report prints the report
+REPORT = os.environ.get("GREENHOUSE_STARTUP_REPORT", "") not in ("", "0") or "--startup-report" in sys.argv
+
+def process_start_time():
+    """
+    Wall clock time the process started at, so the interpreter's own
+    startup is counted too. None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may hold spaces, the fields after it do not
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        started_after_boot = int(fields[19]) / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return time.time() - uptime + started_after_boot
+
+class StartupTimer(object):
+    def __init__(self):
+        """
+        Records when startup phases begin and end, possibly overlapping
+        and on different threads, relative to the start of the process.
+        """
+        self.origin = process_start_time() or time.time()
+        self.imported = time.time()
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def begin(self, name):
+        with self._lock:
+            self.phases[name] = [time.time(), None]
+
+    def end(self, name):
+        with self._lock:
+            self.phases[name][1] = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def done(self, *names):
+        """
+        True once all phases named have ended.
+        """
+        with self._lock:
+            return all(name in self.phases and self.phases[name][1] is not None for name in names)
+
+    def report(self, out=None):
+        """
+        Writes the phases as start and duration in ms since the process
+        started, once.
+        """
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+            phases = sorted((start, end, name) for name, (start, end) in self.phases.items())
+        out = out or sys.stderr
+        out.write("startup phases (ms)        start   duration\n")
+        out.write("{:<24} {:>7.0f} {:>10.0f}\n".format(
+            "interpreter", 0, (self.imported - self.origin) * 1000))
+        for start, end, name in phases:
+            duration = "-" if end is None else "{:.0f}".format((end - start) * 1000)
+            out.write("{:<24} {:>7.0f} {:>10}\n".format(name, (start - self.origin) * 1000, duration))
+        out.flush()
+
+TIMER = StartupTimer()
@@ -1,54 +1,82 @@
+import startup
+startup.TIMER.begin("imports")
+import math
+import threading
+import events
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, GLib
-import pigpio
-import time
-import math
-from my_dht11 import DHT11
-
-from matplotlib.backends.backend_gtk3agg import (
-        FigureCanvasGTK3Agg as FigureCanvas)
-from matplotlib.figure import Figure
-import numpy as np
-
-PIN_STEP = 21
-PIN_ENN = 16
-PIN_DIR = 20
-PIN_LAMP = 26
-PIN_FAN = 13
-PIN_PUMP = 19
-PIN_DHT11_INSIDE = 12
-PIN_DHT11_OUTSIDE = 17
-PIN_LIGHTGATE = 5
-
-ACCELERATION_MS2 = 0.4
-MAX_VELOCITY_MS = 0.2
-HEIGHT_M = 0.335
-STEPS_PER_REV = 1600.0
-PULLEY_DIAMETER_M = 0.012 * (21.3 / 20.0)
-
-PULLEY_CIRCUMF_M = PULLEY_DIAMETER_M * math.pi
-STEPS_PER_M = STEPS_PER_REV / PULLEY_CIRCUMF_M
-TOTAL_STEPS = HEIGHT_M * STEPS_PER_M
-print("total steps: {}".format(TOTAL_STEPS))
-
-DOOR_CLOSED = 0
-DOOR_OPEN = 1
-DOOR_UNKNOWN = 2
+# NumPy, matplotlib and the hardware are only loaded once the window is
+# up, see finish_startup()
+from control import OFF, ON, AUTO
+startup.TIMER.end("imports")
+
+# imported by finish_startup() and connect_greenhouse()
+history = None
+remote = None
+door_module = None
+
+PLOT_WINDOW_S = 3600.0
+PLOT_MAX_FPS = 2.0
+# the widgets are refreshed at most this often, however fast states arrive
+UI_MAX_FPS = 5.0
+# changes smaller than these are not shown, to spare GTK the relayout
+MOISTURE_DEADBAND = 4.0 # ADC counts of 1023
+TEMPERATURE_DEADBAND_C = 0.2
+HUMIDITY_DEADBAND = 0.5
 
 OPEN_DOOR_BUTTON_LABEL = "Open Door"
 CLOSE_DOOR_BUTTON_LABEL = "Close Door"
+OPENING_DOOR_BUTTON_LABEL = "Opening Door {} % (Reverse)"
+CLOSING_DOOR_BUTTON_LABEL = "Closing Door {} % (Reverse)"
+STOP_DOOR_BUTTON_LABEL = "Stop Door"
 
 OFF_LABEL = "OFF"
 ON_LABEL = "ON"
 AUTO_LABEL = "AUTO"
 
-OFF = 0
-ON = 1
-AUTO = 2
-
 RADIO_BUTTON_HEIGHT = 64
 
+class RenderedState(object):
+    def __init__(self):
+        """
+        What the widgets show, so that only the ones whose value changed
+        are pushed to GTK.
+        """
+        self.shown = {}
+
+    def changed(self, key, value, deadband=0.0):
+        """
+        True if value differs from the one shown for key by more than
+        deadband, it is recorded as shown then. A value going missing
+        (NaN) or coming back is a change.
+        """
+        shown = self.shown.get(key)
+        if isinstance(value, float) and isinstance(shown, float):
+            if math.isnan(value) or math.isnan(shown):
+                if math.isnan(value) and math.isnan(shown):
+                    return False
+            elif abs(value - shown) <= deadband:
+                return False
+        elif shown == value:
+            return False
+        self.shown[key] = value
+        return True
+
+    def forget(self, key):
+        # the widget was changed behind the model's back
+        self.shown.pop(key, None)
+
+def shown_value(value, sensor):
+    """
+    Returns value as a float to show, NaN while the sensor's reading is
+    stale or its last acquisition failed.
+    sensor (dict): the sensor's valid and stale flags, from the state
+    """
+    if value is None or sensor["stale"] or not sensor["valid"]:
+        return float("nan")
+    return float(value)
+
 class MyWindow(Gtk.Window):
 
     def __init__(self):
@@ -57,26 +85,24 @@ class MyWindow(Gtk.Window):
         grid = Gtk.Grid()
         self.add(grid)
 
-        self.pi = pigpio.pi()
-        
-        #populate user interface
-
-#        f = Figure(figsize=(5, 4), dpi=100)
-#        a = f.add_subplot(3, 1, 1)
-#        b = f.add_subplot(3, 1, 2)
-#        c = f.add_subplot(3, 1, 3)
-#        t = np.arange(0.0, 3.0, 0.01)
-#        s = np.sin(2*np.pi*t)
-#        a.set_title("Automated Indoor Greenhouse")
-#        a.plot(t, s)
-#        a.plot(t, -s)
-#        b.plot(t, s)
-#        c.plot(t, s)
-
-        
-#        self.plot1 = FigureCanvas(f)
-
+        # the history shown, filled from the daemon, created with the plot
+        self.history = None
+        self.plot = None
+        self.client = None
+        self.last_time = None
+        self.state = None
+        # the latest state is only rendered by render(), at UI_MAX_FPS
+        self.dirty = False
+        self.rendered = RenderedState()
+        # set while the buttons follow the daemon, or are being set up,
+        # so their toggles are not sent back
+        self.updating = True
+
+        # the greenhouse runs in a daemon, started here when none is running
+        self.greenhouse = None
+        self.server = None
 
+        #populate user interface
 
         # self.lamp_button = Gtk.Button(label="Lamp On/Off")
         # self.lamp_button.connect("clicked", self.on_lamp_button_clicked)
@@ -143,6 +169,10 @@ class MyWindow(Gtk.Window):
         self.door_button.set_hexpand(True)
         self.door_button.set_vexpand(True)
 
+        self.door_stop_button = Gtk.Button(label=STOP_DOOR_BUTTON_LABEL)
+        self.door_stop_button.connect("clicked", self.on_door_stop_button_clicked)
+        self.door_stop_button.set_vexpand(True)
+
         self.moisture_levelbars = []
         self.moisture_levelbars_labels = []
         for i in range(8):
@@ -155,9 +185,6 @@ class MyWindow(Gtk.Window):
             if i % 2 == 0:
                 self.moisture_levelbars_labels.append(Gtk.Label("Plant {} (top / bottom)".format(int(i/2))))
 
-        self.last_read_dht11 = 0.0
-        self.inside_dht11 = DHT11(self.pi, PIN_DHT11_INSIDE)
-        self.outside_dht11 = DHT11(self.pi, PIN_DHT11_OUTSIDE)
         self.inside_dht11_label = Gtk.Label("Inside Greenhouse:")
         self.inside_dht11_temp_label = Gtk.Label("")
         self.inside_dht11_humid_label = Gtk.Label("")
@@ -166,10 +193,6 @@ class MyWindow(Gtk.Window):
         self.outside_dht11_humid_label = Gtk.Label("")
 
         self.lightgate_label = Gtk.Label("")
-        self.pi.set_mode(PIN_LIGHTGATE, pigpio.INPUT)
-
-        #self.plot1.set_size_request(480, 600)
-        #grid.attach(self.plot1, left=0, top=0, width=2, height=1)
 
         total_num_cols = 3
         
@@ -203,168 +226,220 @@ class MyWindow(Gtk.Window):
         grid.attach(self.pump_button_on, left=2, top=button_row+1, width=1, height=1)
         grid.attach(self.pump_button_auto, left=2, top=button_row+2, width=1, height=1)
 
-        grid.attach(self.door_button, left=0, top=button_row+3, width=total_num_cols, height=1)
-        
-        self.fullscreen()
-                
-        #initialize wave form sequences for door
-        accel_sequence = []
-        decel_sequence = []
-        const_sequence = []
-
-        current_velocity_ms = 0.0
-        current_steps = 0.0
-        current_height_m = 0.0
-        time_since_start_s = 0.001
-        
-        while current_velocity_ms < MAX_VELOCITY_MS and current_steps < TOTAL_STEPS/2:
-            current_velocity_ms = ACCELERATION_MS2 * time_since_start_s
-            delta_t_s = (1 / STEPS_PER_M) / current_velocity_ms
-            #                              	 ON   	 OFF         DELAY
-            accel_sequence.append(pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-            accel_sequence.append(pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-            
-            decel_sequence.insert(0, pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-            decel_sequence.insert(0, pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-            
-            current_steps += 1
-            time_since_start_s += delta_t_s
+        grid.attach(self.door_button, left=0, top=button_row+3, width=total_num_cols-1, height=1)
+        grid.attach(self.door_stop_button, left=total_num_cols-1, top=button_row+3, width=1, height=1)
 
-        print("accel/decel steps: {}".format(current_steps))
+        # the plot takes this place once it is loaded
+        self.grid = grid
+        self.plot_row = button_row + 4
+        self.plot_placeholder = Gtk.Label("Loading...")
+        self.plot_placeholder.set_size_request(480, 600)
+        grid.attach(self.plot_placeholder, left=0, top=self.plot_row, width=total_num_cols, height=1)
         
-        delta_t_s = (1 / STEPS_PER_M) / MAX_VELOCITY_MS
-        const_sequence.append(pigpio.pulse(1<<PIN_STEP, 0, int((1000000 * delta_t_s) / 2)))
-        const_sequence.append(pigpio.pulse(0, 1<<PIN_STEP, int((1000000 * delta_t_s) / 2)))
-        self.num_steps_const_sequence = int(TOTAL_STEPS - (current_steps * 2))
-        if self.num_steps_const_sequence >= 0xffff:
-            print("burp")
-
-        #initialize door control
-        self.pi.set_mode(PIN_STEP, pigpio.OUTPUT)
-        self.pi.set_mode(PIN_ENN, pigpio.OUTPUT)
-        self.pi.set_mode(PIN_DIR, pigpio.OUTPUT)
-
-
-        self.pi.wave_clear()
-
-        self.pi.wave_add_generic(accel_sequence)
-        self.wid_accel = self.pi.wave_create()
-
-        self.pi.wave_add_generic(decel_sequence)
-        self.wid_decel = self.pi.wave_create()
-
-        self.pi.wave_add_generic(const_sequence)
-        self.wid_const = self.pi.wave_create()
-
-        self.door_position = DOOR_CLOSED
-
-        #initialize lamp control
-        self.pi.set_mode(PIN_LAMP, pigpio.OUTPUT)
-        self.lamp_state = 0
-
-        #initialize fan control
-        self.pi.set_mode(PIN_FAN, pigpio.OUTPUT)
-        self.fan_state = 0
-
-        #initialize pump control
-        self.pi.set_mode(PIN_PUMP, pigpio.OUTPUT)
-        self.pump_state = 0
-
-        #initialize moisture sensors
-
-        # Open SPI bus
-        self.spi = self.pi.spi_open(spi_channel=0, baud=1000000, spi_flags=0)
+        self.fullscreen()
 
-        # initialize timer to periodically read sensor data
-        self.timeout_id = GLib.timeout_add(200, self.on_periodic_timer)
-
-            
-    # Function to read SPI data from MCP3008 chip
-    # Channel must be an integer 0-7
-    def read_mcp_3008(self, channel):
-        count, adc = self.pi.spi_xfer(self.spi, [1,(8+channel)<<4,0])
-        data = ((adc[1]&3) << 8) + adc[2]
-        return data
+        self.updating = False
+        self.first_frame_id = self.connect_after("draw", self.on_first_frame)
+        self.render_timeout_id = GLib.timeout_add(int(1000 / UI_MAX_FPS), self.render)
+
+    def on_first_frame(self, widget, cr):
+        self.disconnect(self.first_frame_id)
+        startup.TIMER.end("first frame")
+        GLib.idle_add(self.finish_startup)
+        return False
+
+    def finish_startup(self):
+        # connect from a thread, starting the greenhouse may take a while,
+        # and meanwhile load the plot here, GTK widgets belong to this thread
+        connector = threading.Thread(target=self.connect_greenhouse)
+        connector.daemon = True
+        connector.start()
+
+        global history
+        with startup.TIMER.phase("plot"):
+            import history
+            from plot import HistoryPlot
+            self.history = history.History()
+            self.plot = HistoryPlot(self.history, window_s=PLOT_WINDOW_S, max_fps=PLOT_MAX_FPS)
+            self.grid.remove(self.plot_placeholder)
+            self.plot.canvas.set_size_request(480, 600)
+            self.grid.attach(self.plot.canvas, left=0, top=self.plot_row, width=3, height=1)
+            self.plot.canvas.show()
+        # redraw the plot periodically, it skips frames it has no budget for
+        self.plot_timeout_id = GLib.timeout_add(int(1000 / PLOT_MAX_FPS), self.plot.update)
+        return False
+
+    def connect_greenhouse(self):
+        global remote, door_module
+        startup.TIMER.begin("first state")
+        with startup.TIMER.phase("connect"):
+            import remote
+            import door as door_module
+            client = remote.Client(self.on_client_message, history_s=PLOT_WINDOW_S)
+            try:
+                client.connect()
+            except OSError:
+                self.start_daemon()
+                client.connect()
+            self.client = client
+
+    def start_daemon(self):
+        # in-process daemon, other user interfaces can still attach to it
+        with startup.TIMER.phase("start greenhouse"):
+            import greenhouse
+            self.greenhouse = greenhouse.Greenhouse()
+            self.server = remote.Server(self.greenhouse)
+            self.greenhouse.start()
+            self.server.start()
 
     def on_lamp_button_toggled(self, button, name):
         if button.get_active():
             self.lamp_state = name
-            if name == OFF or name == ON:
-                self.pi.write(PIN_LAMP, self.lamp_state)
+            if not self.updating and self.client is not None:
+                self.client.set_mode("lamp", name)
+                self.rendered.forget(("mode", "lamp"))
 
-            print("Lamp is now {}".format(self.lamp_state))
+            events.info("ui.mode", output="lamp", mode=self.lamp_state)
         
     def on_fan_button_toggled(self, button, name):
         if button.get_active():
             self.fan_state = name
-            if name == OFF or name == ON:
-                self.pi.write(PIN_FAN, self.fan_state)
+            if not self.updating and self.client is not None:
+                self.client.set_mode("fan", name)
+                self.rendered.forget(("mode", "fan"))
 
-            print("Fan is now {}".format(self.fan_state))
+            events.info("ui.mode", output="fan", mode=self.fan_state)
 
     def on_pump_button_toggled(self, button, name):
         if button.get_active():
             self.pump_state = name
-            if name == OFF or name == ON:
-                self.pi.write(PIN_PUMP, self.pump_state)
+            if not self.updating and self.client is not None:
+                self.client.set_mode("pump", name)
+                self.rendered.forget(("mode", "pump"))
 
-            print("Pump is now {}".format(self.pump_state))
+            events.info("ui.mode", output="pump", mode=self.pump_state)
 
 
     def on_door_button_clicked(self, widget):
-        print("Hello World")
-
-        if self.door_position == DOOR_CLOSED:
-            self.pi.write(PIN_DIR, 0)
-        elif self.door_position == DOOR_OPEN:
-            self.pi.write(PIN_DIR, 1)
-        else:
-            self.pi.write(PIN_ENN, 1)
-            return
-        
-        self.pi.write(PIN_ENN, 0)
-
-        
-        self.pi.wave_chain([
-            self.wid_accel,
-            255, 0,
-            self.wid_const,
-            255, 1, self.num_steps_const_sequence & 0xff, self.num_steps_const_sequence >> 8,
-            self.wid_decel,
-        ])
-
-        while self.pi.wave_tx_busy():
-            time.sleep(0.1);
-
-        self.door_position = 1 - self.door_position
-
-        if self.door_position == DOOR_CLOSED:
-            self.pi.write(PIN_ENN, 1)
-            self.door_button.set_label(OPEN_DOOR_BUTTON_LABEL)
-        else:
-            self.door_button.set_label(CLOSE_DOOR_BUTTON_LABEL)
-
-    def on_periodic_timer(self):
-        self.moisture_data = np.zeros(8)
+        # opens or closes the door, or reverses it while it is moving
+        if self.client is not None:
+            self.client.toggle_door()
+
+    def on_door_stop_button_clicked(self, widget):
+        if self.client is not None:
+            self.client.cancel_door()
+
+    # The client calls this from its own thread, hand messages over to
+    # the GTK main loop
+    def on_client_message(self, message):
+        GLib.idle_add(self.on_message, message)
+
+    def on_message(self, message):
+        kind = message.get("type")
+        if kind == "history":
+            times = remote.decode_array(message["times"])
+            values = remote.decode_array(message["values"], message["columns"])
+            for t, row in zip(times, values):
+                self.add_history(t, row)
+        elif kind == "state":
+            self.update_state(message["state"])
+        elif kind == "disconnected":
+            self.lightgate_label.set_text("Greenhouse daemon not running, reconnecting")
+            self.rendered.forget("lightgate")
+        elif kind == "error":
+            events.error("ui.daemon_error", message=message["message"])
+        return False
+
+    def add_history(self, t, row):
+        # states may repeat the end of the history sent on connecting
+        if self.last_time is None or t > self.last_time:
+            self.history.add(t, row)
+            self.last_time = t
+
+    def update_state(self, state):
+        # the history takes every sampled row, as the daemon's does, the
+        # widgets only the latest state at their own frame rate
+        self.state = state
+        self.dirty = True
+        if state["row_time"] is not None:
+            self.add_history(state["row_time"], state["row"])
+        if not startup.TIMER.done("first state"):
+            startup.TIMER.end("first state")
+            self.render()
+            if startup.REPORT:
+                startup.TIMER.report()
+
+    def render(self):
+        # called at UI_MAX_FPS, pushes only the widgets whose shown value
+        # changed since the last frame
+        if not self.dirty:
+            return True
+        self.dirty = False
+        state = self.state
+        rendered = self.rendered
+        row = state["row"]
+
+        sensors = state["sensors"]
+        moisture = row[history.MOISTURE]
         for i in range(8):
-            self.moisture_data[i] = self.read_mcp_3008(i)
-            self.moisture_levelbars[i].set_value(self.moisture_data[i])
-        print(self.moisture_data)
-
-        if (time.time() - self.last_read_dht11 >= 1):
-            self.inside_dht11.read()
-            self.outside_dht11.read()
-            self.inside_dht11_temp_label.set_text("{} °".format(self.inside_dht11.temperature))
-            self.inside_dht11_humid_label.set_text("{} %".format(self.inside_dht11.humidity))
-            self.outside_dht11_temp_label.set_text("{} °".format(self.outside_dht11.temperature))
-            self.outside_dht11_humid_label.set_text("{} %".format(self.outside_dht11.humidity))
-            self.last_read_dht11 = time.time()
-
-        self.lightgate_label.set_text("Lightgate: {}".format(self.pi.read(PIN_LIGHTGATE)))
-        
+            value = shown_value(moisture[i], sensors["moisture"])
+            if rendered.changed(("moisture", i), value, MOISTURE_DEADBAND):
+                # an empty bar while the reading is missing
+                self.moisture_levelbars[i].set_value(0.0 if math.isnan(value) else value)
+
+        for key, label, column, sensor, deadband, unit in (
+                ("inside_temperature", self.inside_dht11_temp_label, history.INSIDE_TEMPERATURE,
+                 "inside_dht11", TEMPERATURE_DEADBAND_C, "°"),
+                ("inside_humidity", self.inside_dht11_humid_label, history.INSIDE_HUMIDITY,
+                 "inside_dht11", HUMIDITY_DEADBAND, "%"),
+                ("outside_temperature", self.outside_dht11_temp_label, history.OUTSIDE_TEMPERATURE,
+                 "outside_dht11", TEMPERATURE_DEADBAND_C, "°"),
+                ("outside_humidity", self.outside_dht11_humid_label, history.OUTSIDE_HUMIDITY,
+                 "outside_dht11", HUMIDITY_DEADBAND, "%")):
+            value = shown_value(row[column], sensors[sensor])
+            if rendered.changed(key, value, deadband):
+                # one decimal, as the DHT11 gives them, rather than float noise
+                label.set_text("-- {}".format(unit) if math.isnan(value) else "{:.1f} {}".format(value, unit))
+        if rendered.changed("lightgate", row[history.LIGHTGATE]):
+            self.lightgate_label.set_text("Lightgate: {}".format(int(row[history.LIGHTGATE])))
+
+        # follow mode changes made from other user interfaces
+        self.updating = True
+        for name, buttons in (("lamp", (self.lamp_button_off, self.lamp_button_on, self.lamp_button_auto)),
+                              ("fan", (self.fan_button_off, self.fan_button_on, self.fan_button_auto)),
+                              ("pump", (self.pump_button_off, self.pump_button_on, self.pump_button_auto))):
+            mode = state["modes"][name]
+            if rendered.changed(("mode", name), mode):
+                buttons[mode].set_active(True)
+        self.updating = False
+
+        label = self.door_button_label(state["door"])
+        if rendered.changed("door", label):
+            self.door_button.set_label(label)
         return True
-        
-win = MyWindow()
-win.connect("destroy", Gtk.main_quit)
+
+    def door_button_label(self, door):
+        if door["progress"] is not None and door["moving"]:
+            if door["direction"] == door_module.DIR_OPENING:
+                label = OPENING_DOOR_BUTTON_LABEL
+            else:
+                label = CLOSING_DOOR_BUTTON_LABEL
+            return label.format(int(100 * door["progress"]))
+        elif door["position"] == door_module.DOOR_CLOSED:
+            return OPEN_DOOR_BUTTON_LABEL
+        return CLOSE_DOOR_BUTTON_LABEL
+
+    def on_destroy(self, widget):
+        if self.client is not None:
+            self.client.close()
+        if self.server is not None:
+            self.server.stop()
+            self.greenhouse.stop()
+        Gtk.main_quit()
+
+with startup.TIMER.phase("window"):
+    win = MyWindow()
+    win.connect("destroy", win.on_destroy)
+startup.TIMER.begin("first frame")
 win.show_all()
 Gtk.main()
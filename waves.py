@@ -0,0 +1,214 @@
+import numpy as np
+import pigpio
+
+# pigpio limits, see the wave_chain and wave_create documentation
+MAX_WAVES = 250
+MAX_CHAIN_ENTRIES = 600
+MAX_LOOPS = 20
+MAX_LOOP_COUNT = 0xffff
+# Pulses of all created waves together, a wave step is two pulses
+MAX_TOTAL_PULSES = 12000
+
+# Longest wave made of individual steps
+MAX_STEPS_PER_WAVE = 1000
+# Runs of identical steps at least this long are looped instead of
+# being spelled out pulse by pulse
+MIN_LOOP_STEPS = 4
+
+# Relative step period tolerances tried in turn when a ramp does not fit
+# the limits as it is. Rounding periods to a coarser grid makes longer
+# runs of identical steps, which can then be looped.
+TOLERANCES = [0.0, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+# A segment is (delays, count): the wave of step periods delays (tuple of
+# µs) sent count times. count is 1 for spelled out steps.
+
+def _quantize(delays, tolerance):
+    if tolerance == 0:
+        return delays
+    ratio = np.log1p(tolerance)
+    grid = np.rint(np.log(delays.astype(np.float64)) / ratio)
+    return np.rint(np.exp(grid * ratio)).astype(np.uint32)
+
+def _runs(delays):
+    """
+    Run length encodes delays into a list of (delay, count).
+    """
+    if len(delays) == 0:
+        return []
+    starts = np.flatnonzero(np.diff(delays)) + 1
+    starts = np.concatenate(([0], starts))
+    counts = np.diff(np.concatenate((starts, [len(delays)])))
+    return list(zip(delays[starts].tolist(), counts.tolist()))
+
+def _ramp_segments(accel, max_loops):
+    runs = _runs(accel)
+    # Loop the longest runs the loop counters allow
+    long_runs = [i for i, (delay, count) in enumerate(runs) if count >= MIN_LOOP_STEPS]
+    long_runs.sort(key=lambda i: runs[i][1], reverse=True)
+    looped = set()
+    for i in long_runs:
+        loops = _loops_needed(runs[i][1])
+        if loops <= max_loops:
+            looped.add(i)
+            max_loops -= loops
+
+    segments = []
+    literal = []
+    for i, (delay, count) in enumerate(runs):
+        if i in looped:
+            if literal:
+                segments.append((tuple(literal), 1))
+                literal = []
+            segments.append(((delay,), count))
+            continue
+        for n in range(count):
+            literal.append(delay)
+            if len(literal) == MAX_STEPS_PER_WAVE:
+                segments.append((tuple(literal), 1))
+                literal = []
+    if literal:
+        segments.append((tuple(literal), 1))
+    return segments
+
+def _staircase(accel, max_loops):
+    """
+    Last resort for very long ramps: spells out as much of the slow start
+    as wave memory allows and runs the rest as max_loops constant speed
+    stairs, each keeping the duration of the steps it replaces.
+    """
+    # Leave room for the cruise wave, and for a stair or two long
+    # enough to need nested loops
+    stairs = max_loops - 2
+    literal_steps = ((MAX_TOTAL_PULSES - 2) // 2 - 2 * stairs) // 2
+    head = accel[:literal_steps]
+    tail = accel[literal_steps:].astype(np.float64)
+    if len(tail) == 0:
+        return accel
+    logs = np.log(tail)
+    edges = np.linspace(logs[0], logs[-1], stairs + 1)[1:-1]
+    stair = np.searchsorted(-edges, -logs, side='right')
+    sums = np.bincount(stair, weights=tail)
+    counts = np.bincount(stair)
+    levels = np.rint(sums[counts > 0] / counts[counts > 0]).astype(np.uint32)
+    return np.concatenate((head, np.repeat(levels, counts[counts > 0])))
+
+def _loops_needed(count):
+    if count == 1:
+        return 0
+    if count <= MAX_LOOP_COUNT:
+        return 1
+    # nested loop plus a loop for the remainder
+    return 3 if count % MAX_LOOP_COUNT else 2
+
+def _chain_entries(count):
+    if count == 1:
+        return 1
+    if count <= MAX_LOOP_COUNT:
+        return 7
+    return 20 if count % MAX_LOOP_COUNT else 13
+
+def _fits(segments):
+    waves = set(delays for delays, count in segments)
+    pulses = sum(2 * len(delays) for delays in waves)
+    loops = sum(_loops_needed(count) for delays, count in segments)
+    entries = sum(_chain_entries(count) for delays, count in segments)
+    return (len(waves) <= MAX_WAVES and pulses <= MAX_TOTAL_PULSES
+            and loops <= MAX_LOOPS and entries <= MAX_CHAIN_ENTRIES)
+
+def plan(profile):
+    """
+    Splits a move into wave segments that fit pigpio's limits.
+    profile (motion_profile.Profile): step timing of the move
+    Returns (segments, accel): the segments of the move and the ramp step
+    periods actually used, which may be rounded to fit. Ramps too long for
+    that are run as a staircase of constant speed sections at the end.
+    """
+    if profile.const_steps > MAX_LOOP_COUNT ** 2:
+        raise ValueError("move of {} cruise steps is too long".format(profile.const_steps))
+    accel = np.asarray(profile.accel, dtype=np.uint32)
+
+    const_segments = []
+    if profile.const_steps > 0:
+        const_segments.append(((int(profile.const_delay),), int(profile.const_steps)))
+    const_loops = sum(_loops_needed(count) for delays, count in const_segments)
+    ramp_loops = (MAX_LOOPS - const_loops) // 2
+
+    ramps = [_quantize(accel, tolerance) for tolerance in TOLERANCES]
+    ramps.append(_staircase(accel, ramp_loops))
+    for ramp in ramps:
+        accel_segments = _ramp_segments(ramp, ramp_loops)
+        # The deceleration mirrors the ramp segment by segment, so the
+        # segments of a shorter move match the start of a longer one
+        decel_segments = [(delays[::-1], count) for delays, count in reversed(accel_segments)]
+        segments = accel_segments + const_segments + decel_segments
+        if _fits(segments):
+            return segments, ramp
+    raise ValueError("move does not fit in pigpio's wave limits")
+
+class WaveCache(object):
+    def __init__(self, pi, pin_step):
+        """
+        Creates the waves of planned moves and reuses identical waves
+        across segments and moves, so wave memory stays bounded.
+        pi (pigpio): an instance of pigpio
+        pin_step (int): gpio pin of the stepper driver's STEP input
+        """
+        self.pi = pi
+        self.pin_step = pin_step
+        self.waves = {}
+        self.num_pulses = 0
+        self.pi.wave_clear()
+
+    def clear(self):
+        """
+        Deletes all waves. Must not be called while a chain is sent.
+        """
+        self.pi.wave_clear()
+        self.waves = {}
+        self.num_pulses = 0
+
+    def _create(self, delays):
+        pulses = []
+        for delay in delays:
+            #                        ON            OFF           DELAY
+            pulses.append(pigpio.pulse(1<<self.pin_step, 0, delay // 2))
+            pulses.append(pigpio.pulse(0, 1<<self.pin_step, delay - delay // 2))
+        self.pi.wave_add_generic(pulses)
+        wid = self.pi.wave_create()
+        if wid < 0:
+            raise RuntimeError("wave_create failed ({})".format(wid))
+        self.waves[delays] = wid
+        self.num_pulses += len(pulses)
+        return wid
+
+    def chain(self, segments):
+        """
+        Creates any missing waves of segments and returns the wave_chain
+        data that sends them. Creating waves may clear the cache, so this
+        must not be called while a chain is sent.
+        """
+        missing = set(delays for delays, count in segments if delays not in self.waves)
+        missing_pulses = sum(2 * len(delays) for delays in missing)
+        if (len(self.waves) + len(missing) > MAX_WAVES
+                or self.num_pulses + missing_pulses > MAX_TOTAL_PULSES):
+            # Out of wave memory, start over with only what this chain needs
+            self.clear()
+        for delays, count in segments:
+            if delays not in self.waves:
+                self._create(delays)
+
+        data = []
+        for delays, count in segments:
+            wid = self.waves[delays]
+            if count == 1:
+                data.append(wid)
+            elif count <= MAX_LOOP_COUNT:
+                data += [255, 0, wid, 255, 1, count & 0xff, count >> 8]
+            else:
+                outer, rest = divmod(count, MAX_LOOP_COUNT)
+                data += [255, 0, 255, 0, wid, 255, 1, 0xff, 0xff,
+                         255, 1, outer & 0xff, outer >> 8]
+                if rest:
+                    data += [255, 0, wid, 255, 1, rest & 0xff, rest >> 8]
+        return data